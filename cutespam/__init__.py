@@ -83,6 +83,10 @@ def make_request(url, method, ratelimit_retry = False, useragent = config.userag
 
 import queue
 import collections
+import threading
+import bisect
+
+from contextlib import contextmanager
 
 # http://code.activestate.com/recipes/576694/ by Raymond Hettinger
 
@@ -146,11 +150,98 @@ class OrderedSet(collections.abc.MutableSet):
 # https://stackoverflow.com/questions/16506429/check-if-element-is-already-in-a-queue by abarnert
 
 class OrderedSetQueue(queue.Queue):
+    """ FIFO queue that drops items which are queued already """
+
     def _init(self, maxsize):
         self.queue = OrderedSet()
 
     def _put(self, item):
+        if item in self.queue:
+            # put counts every item as a task right after this, a dropped one must not stay unfinished
+            self.unfinished_tasks -= 1
         self.queue.add(item)
         
     def _get(self):
-        return self.queue.pop()
+        return self.queue.pop(last = False)
+
+
+class RWLock:
+    """ Allows either any number of readers or a single writer. Waiting writers block new readers """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try: yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers: self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        try: yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+class PrefixIndex:
+    """
+    Sorted strings with a reference count, finds all strings that start with a prefix.
+    Case insensitive like the like operator of sqlite.
+    """
+
+    def __init__(self, counts = None):
+        """ counts is an iterable of (string, count) """
+        self._lock = threading.Lock()
+        self._counts = dict(counts or ())
+        self._keys = sorted((key.lower(), key) for key in self._counts)
+
+    def add(self, key, count = 1):
+        with self._lock:
+            n = self._counts.get(key, 0)
+            self._counts[key] = n + count
+            if not n: bisect.insort(self._keys, (key.lower(), key))
+
+    def discard(self, key, count = 1):
+        with self._lock:
+            n = self._counts.get(key)
+            if n is None: return
+            if n > count:
+                self._counts[key] = n - count
+                return
+
+            del self._counts[key]
+            del self._keys[bisect.bisect_left(self._keys, (key.lower(), key))]
+
+    def __contains__(self, key):
+        return key in self._counts
+
+    def __len__(self):
+        return len(self._counts)
+
+    def prefixed(self, prefix: str) -> list:
+        """ returns all strings that start with prefix in sorted order """
+        prefix = prefix.lower()
+        ret = []
+        with self._lock:
+            i = bisect.bisect_left(self._keys, (prefix,))
+            while i < len(self._keys) and self._keys[i][0].startswith(prefix):
+                ret.append(self._keys[i][1])
+                i += 1
+        return ret
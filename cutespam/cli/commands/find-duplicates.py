@@ -1,5 +1,7 @@
 import argparse
 
+from cutespam.cli import argrange
+
 DESCRIPTION = "Finds duplicate image files and generates a html page showing them"
 
 def main(ARGS):
@@ -8,8 +10,7 @@ def main(ARGS):
 
     from PIL import Image
 
-    from cutespam.xmpmeta import CuteMeta
-    from cutespam.db import find_all_duplicates, picture_file_for_uid
+    from cutespam.db import find_all_duplicates, find_all_near_duplicates, picture_file_for_uid, get_metas
 
     def html_output(duplicates):
         t_html = """
@@ -47,6 +48,8 @@ def main(ARGS):
             </table>
         """
 
+        metas = get_metas([uid for duplicate in duplicates for uid in duplicate])
+
         tables = ""
         for duplicate in duplicates:
             images = ""
@@ -61,7 +64,7 @@ def main(ARGS):
                     width, height = img_data.size
                     fformat = img_data.format
 
-                meta = CuteMeta.from_db(uid)
+                meta = metas[uid]
                 path = str(d.resolve().absolute())
                 images += f"<td><img src='{path}'/></td>"
                 links += f"<td><a href={path}><code>{path}</code></a></td>"
@@ -72,7 +75,10 @@ def main(ARGS):
 
         return t_html.format(tables = tables)
 
-    duplicates = find_all_duplicates()
+    if ARGS.threshold < 100:
+        duplicates = find_all_near_duplicates(ARGS.threshold / 100, ARGS.workers)
+    else:
+        duplicates = find_all_duplicates()
 
     if len(duplicates) > 0:
         res = html_output(duplicates)
@@ -84,4 +90,10 @@ def main(ARGS):
 
 def args(parser):
     parser.add_argument("outf", help = "Output file")
+    parser.add_argument("-t", "--threshold", default = 100, type = int, choices = argrange(0, 100), metavar = "[0-100]",
+        help = "Also finds near duplicates and groups all images that are connected by this similarity")
+    parser.add_argument("-w", "--workers", type = int,
+        help = "Number of processes that search for near duplicates, defaults to the number of cpus. "
+            "The search tables take about 1.6 KB per image and are shared with the processes copy-on-write, "
+            "but every process can end up with its own copy of the pages it reads")
     
\ No newline at end of file
@@ -0,0 +1,34 @@
+import argparse
+
+DESCRIPTION = "Prints the perceptual hash of image files. Folders get hashed in parallel"
+
+def main(ARGS):
+    import sys
+    from pathlib import Path
+
+    from cutespam import all_files_in_folders
+    from cutespam.hash import hash_imgs
+
+    if ARGS.file and ARGS.file[0] == "-" and not sys.stdin.isatty():
+        ARGS.file = sys.stdin.read().splitlines()
+
+    def files():
+        for file in map(Path, ARGS.file):
+            if file.is_dir():
+                yield from (f for f in all_files_in_folders([file]) if f.suffix != ".xmp")
+            else: yield file
+
+    for file, h in hash_imgs(files(), ARGS.workers, ARGS.draft, ARGS.ordered, cache = not ARGS.no_cache):
+        if h: print(h, file)
+
+def args(parser):
+    parser.add_argument("-w", "--workers", type = int,
+        help = "Number of processes, defaults to the number of cpus")
+    parser.add_argument("--draft", action = "store_true",
+        help = "Lets the decoder scale down JPEG images while loading them.\nFaster, but the hashes differ slightly from the ones cutespam stores")
+    parser.add_argument("--no-cache", action = "store_true",
+        help = "Hashes every file again instead of using the hashes of unchanged files")
+    parser.add_argument("--ordered", action = "store_true",
+        help = "Prints the hashes in the same order as the files instead of as soon as they are done")
+
+    parser.add_argument("file", nargs = "+", help = "Image files or folders")
@@ -13,7 +13,7 @@ def main(ARGS):
     from cutespam import yn_choice
     from cutespam.api import read_meta_from_dict, get_cached_file
     from cutespam.iqdb import iqdb, upscale
-    from cutespam.hash import hash_img
+    from cutespam.hash import hash_imgs
     from cutespam.xmpmeta import CuteMeta
     from cutespam.config import config
     from cutespam.db import find_similar_images_hash, picture_file_for_uid
@@ -21,13 +21,14 @@ def main(ARGS):
     if ARGS.file and ARGS.file[0] == "-" and not sys.stdin.isatty():
         ARGS.file = sys.stdin.read().splitlines()
 
-    for file in ARGS.file:
-        file = Path(file)
-        if file.suffix == ".xmp": continue
+    # The hashes get calculated in the background while the files are being imported
+    files = [Path(file) for file in ARGS.file if Path(file).suffix != ".xmp"]
+    for file, h in hash_imgs(files, ordered = True):
+        if not h: continue
         xmpfile = file.with_suffix(".xmp")
 
         meta = CuteMeta(filename = xmpfile)
-        meta.hash = hash_img(file)
+        meta.hash = h
 
         similar = find_similar_images_hash(meta.hash, 0.9)
         if similar:
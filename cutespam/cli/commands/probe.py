@@ -1,5 +1,6 @@
 import argparse
 from cutespam.cli import UUIDFileCompleter
+from cutespam.xmpmeta import CuteMeta
 
 DESCRIPTION = "Outputs a file's tags"
 
@@ -15,6 +16,13 @@ def main(ARGS):
     if ARGS.file and ARGS.file[0] == "-" and not sys.stdin.isatty():
         ARGS.file = sys.stdin.read().splitlines()
 
+    # Everything that is a uid gets fetched at once
+    uids = []
+    for file in ARGS.file:
+        try: uids.append(UUID(file))
+        except ValueError: pass
+    metas = db.get_metas(uids, ARGS.tag) if uids else {}
+
     if ARGS.json:
         print("[")
     for i, file in enumerate(ARGS.file):
@@ -23,8 +31,7 @@ def main(ARGS):
             cute_meta = CuteMeta.from_file(fp.with_suffix(".xmp"))
         else:
             try: 
-                uid = UUID(file)
-                cute_meta = CuteMeta.from_db(uid)
+                cute_meta = metas[UUID(file)]
             except:
                 if not ARGS.json: 
                     print("\n".join(str(uid) for uid in db.get_tab_complete_uids(file)))
@@ -40,7 +47,7 @@ def main(ARGS):
         print("]")
 
 def args(parser):
-    parser.add_argument("--tag", nargs = "+",
+    parser.add_argument("--tag", nargs = "+", choices = CuteMeta.tag_names(),
         help = "List of tags to include")
     parser.add_argument("--json", action = "store_true",
         help = "Output as json")
@@ -15,11 +15,12 @@ def main(ARGS):
         source = ARGS.source,
         rating = ARGS.rating,
         limit = ARGS.limit,
-        random = ARGS.random
+        random = ARGS.random,
+        count = ARGS.count
     )
 
     if ARGS.count:
-        print(len(filtered))
+        print(filtered)
     else:
         l = [(picture_file_for_uid(uid).absolute().as_uri() if ARGS.uri else str(uid)) for uid in filtered]
         if ARGS.json:
@@ -0,0 +1,34 @@
+import argparse
+
+DESCRIPTION = "Full text search over caption, author, source and keywords, best matches first"
+
+def main(ARGS):
+    from cutespam.db import search, picture_file_for_uid
+    import json
+
+    found = search(" ".join(ARGS.text), limit = ARGS.limit, raw = ARGS.raw)
+
+    if ARGS.count:
+        print(len(found))
+    else:
+        l = [(picture_file_for_uid(uid).absolute().as_uri() if ARGS.uri else str(uid)) for uid in found]
+        if ARGS.json:
+            print(json.dumps(l, indent = 4))
+        else:
+            print("\n".join(l))
+
+def args(parser):
+    parser.add_argument("--json", action = "store_true",
+        help = "Outputs a json array instead of an unformatted list")
+    parser.add_argument("--uri", action = "store_true",
+        help = "Emits absolute file:// URIs instead of relative paths")
+    parser.add_argument("--limit", type = int,
+        help = "Limits the amount of results")
+    parser.add_argument("--count", action = "store_true",
+        help = "Count the number of results instead of emitting them")
+    parser.add_argument("--raw", action = "store_true",
+        help = "Passes the text on as an SQLite FTS5 query")
+
+    parser.add_argument("text", nargs = "+",
+        help = "Words match the start of a word, \"quoted phrases\" need to match as a whole.\n"
+            "caption:, author:, source: or keywords: in front of a word only search that field")
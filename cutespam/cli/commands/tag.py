@@ -8,7 +8,6 @@ DESCRIPTION = "Modify a file's tag values"
 def main(ARGS):
     import sys
     from uuid import UUID
-    from datetime import datetime
     from pathlib import Path
 
     from cutespam import yn_choice
@@ -16,6 +15,8 @@ def main(ARGS):
     if ARGS.file and ARGS.file[0] == "-" and not sys.stdin.isatty():
         ARGS.file = sys.stdin.read().splitlines()
 
+    if len(ARGS.file) > 1 and bulk_edit(ARGS): return
+
     for file in ARGS.file:
         asked_confirm_multiple = False  # Make sure not not ask on every file
 
@@ -31,19 +32,10 @@ def main(ARGS):
     
         if ARGS.subcommand == "set":
             tpe = getattr(CuteMeta, tag).type
-            val = ARGS.value
-            # this was in the wrong order, oops
-            if len(val) == 1:
-                val = val[0]
-            if issubclass(tpe, datetime):
-                try:
-                    val = datetime.strptime(val, "%Y-%m-%d %H:%M:%S")
-                except ValueError:
-                    print("Invalid date format, use YY-MM-DD HH:MM:SS")
-                    return
-            else: 
-                # Make sure that we can convert into it!
-                val = tpe(val)
+            try: val = parse_value(tag, ARGS.value)
+            except ValueError as e:
+                print(e)
+                return
 
             curr_v = getattr(cute_meta, tag)   
             if curr_v and issubclass(tpe, (list, set)) and not asked_confirm_multiple:
@@ -76,6 +68,56 @@ def main(ARGS):
 
         cute_meta.write()
 
+def parse_value(tag, values):
+    """ Converts the values from the command line to the type of tag, raises ValueError with a message if they don't fit """
+    from datetime import datetime
+
+    tpe = getattr(CuteMeta, tag).type
+    if issubclass(tpe, (list, set)):
+        return tpe(values)
+    if len(values) > 1:
+        raise ValueError(f"{tag} only takes a single value")
+
+    if issubclass(tpe, datetime):
+        try:
+            return datetime.strptime(values[0], "%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            raise ValueError("Invalid date format, use YY-MM-DD HH:MM:SS")
+    # Make sure that we can convert into it!
+    return tpe(values[0])
+
+def bulk_edit(ARGS):
+    """ Edits many uids in one transaction, returns False if the edit needs to go through every file """
+    from uuid import UUID
+
+    from cutespam import yn_choice
+    from cutespam import db
+
+    try: uids = [UUID(file) for file in ARGS.file]
+    except ValueError: return False
+
+    tag = ARGS.tag
+    if ARGS.subcommand in ("add", "remove"):
+        if tag != "keywords": return False
+        if ARGS.subcommand == "add": db.add_keywords(uids, ARGS.value)
+        else: db.remove_keywords(uids, ARGS.value)
+    elif ARGS.subcommand in ("set", "delete"):
+        if tag not in db.BULK_FIELDS: return False
+        if ARGS.subcommand == "delete": val = None
+        else:
+            try: val = parse_value(tag, ARGS.value)
+            except ValueError as e:
+                print(e)
+                return True
+            if issubclass(getattr(CuteMeta, tag).type, (list, set)):
+                if not yn_choice("You are about to overwrite multiple values, proceed?"): return True
+
+        try: db.set_field(uids, tag, val)
+        except ValueError as e: print(e)
+    else: return False
+
+    return True
+
 def args(parser):
 
     def unescaped_string(arg_str):
@@ -6,12 +6,24 @@ class BaseConfig:
     # Values that can't be modified (i.e they depend on other settings)
     metadbf: Path
     hashdbf: Path
+    hashcachef: Path
     imgcache: Path
 
 @dataclass
 class Config(BaseConfig):
     service_port: int = 14400
     hash_length: int = 256
+    # "trie", "matrix" or "mih" (multi-index hashing). Only matrix reads the hash index file in place
+    # through mmap, trie and mih rebuild themselves from it on every start
+    hash_backend: str = "trie"
+    hash_cache_size: int = 100_000 # Number of image hashes to remember, 0 disables the cache
+
+    # Settings for the sqlite connections to the metadata database
+    db_journal_mode: str = "wal" # wal lets reads continue while another connection writes
+    db_synchronous: str = "normal"
+    db_cache_size: int = 65536 # KiB of page cache per connection
+    db_mmap_size: int = 268435456 # bytes of the database that get memory mapped, 0 disables it
+    db_busy_timeout: float = 30 # seconds to wait for a lock held by another connection
 
     thumbnail_size: int = 256
     thumbnail_min_filesize: int = 100
@@ -79,6 +91,7 @@ def _read_config():
 
     config.metadbf = config.cache_folder / "metadata.db"
     config.hashdbf = config.cache_folder / "hashes.db"
+    config.hashcachef = config.cache_folder / "hashcache.db"
     config.imgcache = config.cache_folder / "imgcache"
     config.imgcache.mkdir(parents = True, exist_ok = True)
 
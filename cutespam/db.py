@@ -10,10 +10,11 @@ from watchdog.events import FileSystemEventHandler, FileCreatedEvent, FileDelete
 from math import ceil, floor
 from threading import Thread, RLock
 from contextlib import contextmanager
-from functools import wraps
+from functools import wraps, lru_cache
 
-from cutespam import log, OrderedSetQueue, OrderedSet
-from cutespam.hashtree import HashTree
+from cutespam import log, OrderedSetQueue, RWLock, PrefixIndex
+from cutespam.hashtree import CompactHashTree
+from cutespam.hashindex import is_index_file
 from cutespam.config import config
 from cutespam.xmpmeta import CuteMeta, Rating
 
@@ -32,9 +33,11 @@ sqlite3.register_converter("PSet", lambda v: set(json.loads(v.decode())))
 # Make sure only one thread talks to this
 
 #__folder_lock = Lock() # TODO These can deadlock, figure out a better way of handling this
-#__hashes_lock = Lock()
-__lock = RLock() # This effectively makes everything single threaded
-__hashes: HashTree = None
+__hashes_lock = RWLock() # Similarity searches can run at the same time, changes need to wait for them
+__lock = RLock() # This effectively makes everything else single threaded
+__hashes = None # see hash_backend()
+__keywords = PrefixIndex() # Tab completion, counts how many images use every keyword
+__uids = PrefixIndex() # Tab completion, hex strings of all uids
 
 __db: sqlite3.Connection = None
 __rpccon = None
@@ -68,21 +71,147 @@ def dbfun(fun):
     _functions[fun.__name__] = wrapper
     return wrapper
 
+@lru_cache(maxsize = 32)
+def _compile_regexp(expr):
+    return re.compile(expr)
+
 def regexp(expr, item):
-    reg = re.compile(expr)
-    return reg.search(item) is not None
+    # Runs for every row that gets checked, the expression is almost always config.tag_regex
+    return _compile_regexp(expr).search(item) is not None
+
+class _Connection(sqlite3.Connection):
+    """ Runs the functions in on_commit once the transaction is committed, a rollback drops them """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_commit = []
+
+    def commit(self):
+        super().commit()
+        on_commit, self.on_commit = self.on_commit, []
+        for fun in on_commit: fun()
+
+    def rollback(self):
+        super().rollback()
+        self.on_commit = []
 
 def connect_db():
-    db = sqlite3.connect(str(config.metadbf), detect_types = sqlite3.PARSE_DECLTYPES)
-    db.create_function("REGEXP", 2, regexp)
+    db = sqlite3.connect(str(config.metadbf), detect_types = sqlite3.PARSE_DECLTYPES, timeout = config.db_busy_timeout, factory = _Connection)
+    if sys.version_info >= (3, 8):
+        db.create_function("REGEXP", 2, regexp, deterministic = True)
+    else: db.create_function("REGEXP", 2, regexp)
     db.row_factory = sqlite3.Row
+
+    db.execute(f"PRAGMA journal_mode = {config.db_journal_mode}")
+    db.execute(f"PRAGMA synchronous = {config.db_synchronous}")
+    db.execute(f"PRAGMA cache_size = {-int(config.db_cache_size)}")
+    db.execute(f"PRAGMA mmap_size = {int(config.db_mmap_size)}")
     return db
 
+def log_progress(name):
+    """ Returns a progress callback that logs every 10% """
+    last = -1
+    def progress(done, total):
+        nonlocal last
+        percent = done * 100 // total if total else 100
+        if percent // 10 > last:
+            last = percent // 10
+            log.info("%s: %d%%", name, percent)
+    return progress
+
+def hash_backend():
+    """ Returns the class used to store the image hashes, set with config.hash_backend """
+    if config.hash_backend == "trie":
+        return CompactHashTree
+    elif config.hash_backend == "matrix":
+        from cutespam.hashmatrix import HashMatrix
+        return HashMatrix
+    elif config.hash_backend == "mih":
+        from cutespam.multiindex import MultiIndexHash
+        return MultiIndexHash
+    raise ValueError("Unknown hash backend %r" % config.hash_backend)
+
+def _add_file_columns(db: sqlite3.Connection):
+    # Databases created after this have them already
+    columns = set(c["name"] for c in db.execute("PRAGMA table_info(Metadata)"))
+    for column in _FILE_COLUMNS:
+        if column not in columns:
+            db.execute(f"ALTER TABLE Metadata ADD COLUMN {column} INTEGER")
+
+def _add_indexes(db: sqlite3.Connection):
+    # Duplicates need to go before the unique indexes can be created
+    for statement in (
+        """DELETE FROM Metadata_Keywords WHERE rowid NOT IN (
+            SELECT min(rowid) FROM Metadata_Keywords GROUP BY uid, keyword
+        )""",
+        """DELETE FROM Metadata_Collections WHERE rowid NOT IN (
+            SELECT min(rowid) FROM Metadata_Collections GROUP BY uid, collection
+        )""",
+        "CREATE UNIQUE INDEX IF not EXISTS Metadata_Keywords_uid ON Metadata_Keywords (uid, keyword)",
+        "CREATE INDEX IF not EXISTS Metadata_Keywords_keyword ON Metadata_Keywords (keyword, uid)",
+        "CREATE UNIQUE INDEX IF not EXISTS Metadata_Collections_uid ON Metadata_Collections (uid, collection)",
+        "CREATE INDEX IF not EXISTS Metadata_hash ON Metadata (hash)"
+    ): db.execute(statement)
+
+def _normalize_keywords(db: sqlite3.Connection):
+    # Every keyword is stored once in Keywords, Metadata_Keywords only references it
+    for statement in (
+        f"""CREATE TABLE Keywords (
+            id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL CHECK (name REGEXP '{config.tag_regex}')
+        )""",
+        "INSERT INTO Keywords (name) SELECT DISTINCT keyword FROM Metadata_Keywords ORDER BY keyword",
+        """CREATE TABLE Metadata_Keywords_ids (
+            uid UUID not null,
+            keyword_id INTEGER not null REFERENCES Keywords (id),
+            PRIMARY KEY (uid, keyword_id)
+        ) WITHOUT ROWID""",
+        """INSERT INTO Metadata_Keywords_ids 
+            SELECT uid, Keywords.id FROM Metadata_Keywords JOIN Keywords ON Keywords.name = Metadata_Keywords.keyword""",
+        "DROP TABLE Metadata_Keywords",
+        "ALTER TABLE Metadata_Keywords_ids RENAME TO Metadata_Keywords",
+        "CREATE INDEX Metadata_Keywords_keyword ON Metadata_Keywords (keyword_id, uid)"
+    ): db.execute(statement)
+
+def _add_search(db: sqlite3.Connection):
+    # Metadata doesn't have a rowid, Metadata_Search_Rows gives every uid one for the full text index
+    for statement in (
+        """CREATE TABLE Metadata_Search_Rows (
+            id INTEGER PRIMARY KEY,
+            uid UUID UNIQUE not null
+        )""",
+        "CREATE VIRTUAL TABLE Metadata_Search USING fts5(caption, author, source, keywords)",
+        "INSERT INTO Metadata_Search_Rows (uid) SELECT uid FROM Metadata"
+    ): db.execute(statement)
+    db.execute(f"""
+        INSERT INTO Metadata_Search (rowid, caption, author, source, keywords)
+        {_SEARCH_SELECT}
+    """)
+
+# Schema changes, PRAGMA user_version is the number of migrations that ran on a database.
+# Only ever append to this, the tables created in init_db are version 0.
+_MIGRATIONS = [
+    _add_file_columns,
+    _add_indexes,
+    _normalize_keywords,
+    _add_search,
+]
+
+def _migrate(db: sqlite3.Connection):
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    for n, migration in enumerate(_MIGRATIONS[version:], start = version + 1):
+        log.info("Migrating database to version %d", n)
+        db.execute("BEGIN") # Every migration runs in its own transaction
+        migration(db)
+        db.execute(f"PRAGMA user_version = {n}")
+        db.commit()
+
 def init_db():
-    global __db, __hashes
+    global __db, __hashes, __keywords, __uids
 
 
     log.info("Scanning database")
+    opened = datetime.utcnow()
 
     refresh_cache = False
     if not config.metadbf.exists() or not config.hashdbf.exists():
@@ -104,7 +233,9 @@ def init_db():
             date timestamp not null DEFAULT(strftime('%Y-%m-%d %H:%M:%f', 'now')),
             rating Rating,
             source_other PSet,
-            source_via PSet
+            source_via PSet,
+            file_size INTEGER,
+            file_mtime INTEGER
         ) WITHOUT ROWID;
 
         CREATE TABLE IF not EXISTS Metadata_Keywords (
@@ -116,85 +247,192 @@ def init_db():
             uid UUID not null,
             collection TEXT NOT NULL CHECK (collection REGEXP '{config.tag_regex}')
         );
+
+        CREATE TABLE IF not EXISTS State (
+            key TEXT PRIMARY KEY not null,
+            value
+        ) WITHOUT ROWID;
     """)
 
+    _migrate(__db)
+
     if refresh_cache:
-        __hashes = HashTree(config.hash_length)
+        __hashes = hash_backend()(config.hash_length)
 
         log.info("Loading folder %r into database", str(config.image_folder))
+        _load_folder((xmpf for xmpf, _ in _scan_folder()), __db)
 
-        for xmpf in config.image_folder.glob("*.xmp"):
-            if not xmpf.is_file(): continue
-            if xmpf.name.startswith("."): continue
-            _load_file(xmpf, __db)
-
-        __db.commit()
-        with open(config.hashdbf, "wb") as hashdbfp, __lock:
+        with __hashes_lock.read():
             log.info("Writing hashes to file...")
-            __hashes.write_to_file(hashdbfp)
+            __hashes.write_to_index(config.hashdbf)
 
-    else:
-        with open(config.hashdbf, "rb") as hashdbfp, __lock:
+    elif is_index_file(config.hashdbf):
+        with __hashes_lock.write():
             log.info("Loading hashes from cache %r", str(config.hashdbf))
-            __hashes = HashTree.read_from_file(hashdbfp, config.hash_length)
+            __hashes = hash_backend().read_from_index(config.hashdbf, config.hash_length)
+    else:
+        # Written by an older version, gets replaced with an index file on exit
+        with open(config.hashdbf, "rb") as hashdbfp, __hashes_lock.write():
+            log.info("Converting hashes from cache %r", str(config.hashdbf))
+            __hashes = hash_backend().read_from_file(hashdbfp, config.hash_length, progress = log_progress("Loading hashes"))
 
     log.info("Catching up with image folder")
-    uuids_in_folder = set()
-    for xmpf in config.image_folder.glob("*.xmp"):
-        if not xmpf.is_file(): continue
-        if xmpf.name.startswith("."): continue
-
-        try:
-            uuid = UUID(xmpf.stem)
-            uuids_in_folder.add(uuid)
+    started = time.time()
+    last_sync = None if refresh_cache else _get_state("last_sync", __db)
 
+    stats = {}
+    for xmpf, stat in _scan_folder():
+        try: stats[UUID(xmpf.stem)] = stat
         except: continue
-    uuids_in_database = set(d[0] for d in __db.execute("select uid from Metadata").fetchall())
+    uuids_in_folder = set(stats)
+    stats_in_database = {d[0]: (d[1], d[2]) for d in __db.execute("select uid, file_size, file_mtime from Metadata")}
+    uuids_in_database = set(stats_in_database)
 
     for uid in uuids_in_folder - uuids_in_database: # recently added
         _load_file(xmp_file_for_uid(uid), __db)
     for uid in uuids_in_database - uuids_in_folder: # recently deleted
         _remove_image(uid, __db)
 
-    for uid in uuids_in_database:
-        try:
-            _save_file(xmp_file_for_uid(uid), __db)
-        except FileNotFoundError: pass # was deleted earlier
+    # Only files that changed since they were synced can differ from the database.
+    # Entries from before the file stats were stored are checked if they were modified since the last start,
+    # the slack accounts for file systems with a coarse mtime
+    if not refresh_cache:
+        for uid in uuids_in_database & uuids_in_folder:
+            if stats_in_database[uid] == (None, None):
+                if last_sync is not None and stats[uid][1] < (last_sync - 2) * 1e9: continue
+            elif stats_in_database[uid] == stats[uid]: continue
+            try:
+                _save_file(xmp_file_for_uid(uid), __db)
+            except FileNotFoundError: pass # was deleted earlier
 
+    _set_state("last_sync", started, __db)
+    # Keywords that aren't used by any image anymore
+    __db.execute("DELETE FROM Keywords WHERE NOT EXISTS (SELECT 1 FROM Metadata_Keywords WHERE keyword_id = Keywords.id)")
     __db.commit()
+
+    # Changed since the last start, some of them might not have made it to their file
+    _mark_dirty(uid for uid, in __db.execute("select uid from Metadata where last_updated > ?", (
+        datetime.utcfromtimestamp(last_sync) if last_sync is not None else opened,
+    )))
+
+    __keywords = PrefixIndex(__db.execute("""
+        SELECT name, count(*) FROM Metadata_Keywords JOIN Keywords ON id = keyword_id GROUP BY keyword_id
+    """))
+    __uids = PrefixIndex((uid.hex, 1) for uid, in __db.execute("SELECT uid FROM Metadata"))
         
 
     log.info("Done!")
     def exit():
+        log.info("Writing pending changes to files")
+        for dirty in __dirty:
+            if __writers_running: dirty.join()
+            else: _write_dirty(dirty, __db)
+
         log.info("Closing database connection")
         __db.commit()
         __db.close()
 
-        with open(config.hashdbf, "wb") as hashdbfp, __lock:
+        with __hashes_lock.read():
             log.info("Writing hashes to file...")
-            __hashes.write_to_file(hashdbfp)
+            __hashes.write_to_index(config.hashdbf)
         
         log.info("Done!")
 
     atexit.register(exit)
 
+def _scan_folder():
+    """ yields every xmp file in the image folder with its (size, mtime) """
+    with os.scandir(config.image_folder) as entries:
+        for entry in entries:
+            if not entry.name.endswith(".xmp"): continue
+            if entry.name.startswith("."): continue
+            if not entry.is_file(): continue
+            stat = entry.stat()
+            yield Path(entry.path), (stat.st_size, stat.st_mtime_ns)
+
+_FILE_COLUMNS = ("file_size", "file_mtime")
+
+def _file_stat(xmpf: Path):
+    """ (size, mtime) of a file, stored in the database to find out if the file changed since it was synced """
+    stat = os.stat(xmpf)
+    return stat.st_size, stat.st_mtime_ns
+
+def _set_file_stat(uid: UUID, stat, db: sqlite3.Connection):
+    db.execute("update Metadata set file_size = ?, file_mtime = ? where uid is ?", (*stat, uid))
+
+def _get_state(key: str, db: sqlite3.Connection, default = None):
+    res = db.execute("select value from State where key is ?", (key,)).fetchone()
+    return res[0] if res else default
+
+def _set_state(key: str, value, db: sqlite3.Connection):
+    db.execute("insert or replace into State values (?, ?)", (key, value))
+
 def start_listeners():
     log.info("Listening for file changes")
     listen_for_file_changes()
 
-    db_listener = Thread(target = listen_for_db_changes)
-    db_listener.name = "Database change listener"
-    db_listener.daemon = True
-    db_listener.start()
+    log.info("Writing database changes to files")
+    start_writers()
+
+# File events are collected per file and applied once no new event came in for _EVENT_DELAY seconds,
+# or after waiting for _EVENT_MAX_DELAY seconds. Up to _EVENT_BATCH files are applied in one transaction.
+_EVENT_DELAY = 0.5
+_EVENT_MAX_DELAY = 5
+_EVENT_BATCH = 1000
+
+def _is_xmp_file(file: Path):
+    if file.suffix != ".xmp": return False
+    if file.name.startswith("."): return False
+    try:
+        UUID(file.stem)
+        return True
+    except: return False
+
+def _apply_file_event(xmpf: Path, db: sqlite3.Connection) -> bool:
+    """
+    Brings the database in line with the current state of the file, no matter which events lead to it.
+    returns True if the file might need to be written back
+    """
+    uid = UUID(xmpf.stem)
+    in_database = db.execute("select 1 from Metadata where uid is ?", (uid,)).fetchone()
+
+    if xmpf.is_file():
+        if in_database: return _save_file(xmpf, db)
+        _load_file(xmpf, db)
+        return True # autogenerated keywords
+    elif in_database:
+        _remove_image(uid, db)
+    return False
+
+def _apply_file_events(events, db: sqlite3.Connection) -> list:
+    """ 
+    Applies a list of (file, event) in one transaction, every file gets its own savepoint.
+    returns the events that failed
+    """
+    failed = []
+    dirty = []
+    with __lock:
+        db.execute("BEGIN")
+        for xmpf, event in events:
+            db.execute("SAVEPOINT file_event")
+            on_commit = len(db.on_commit)
+            try:
+                if _apply_file_event(xmpf, db):
+                    dirty.append(UUID(xmpf.stem))
+            except Exception as e:
+                log.warning("Event %s failed: %s", event, e)
+                db.execute("ROLLBACK TO file_event")
+                del db.on_commit[on_commit:]
+                failed.append(event)
+            db.execute("RELEASE file_event")
+        db.commit()
+    _mark_dirty(dirty)
+    return failed
 
 def listen_for_file_changes():
     event_queue = OrderedSetQueue()
-
-    def retry(action, event): # TODO Untested
-        try: action()
-        except:
-            log.warn("Event %s failed, adding to backlog", event)
-            event_queue.put(event)
+    pending = {} # file -> (last event, time of the first event, time of the last event)
+    pending_lock = RLock()
 
     def poll_failed():
         while True:
@@ -209,54 +447,62 @@ def listen_for_file_changes():
     failed_retry.daemon = True
     failed_retry.start()
 
-    class EventHandler(FileSystemEventHandler):
-        def __init__(self):
-            self._db = None
+    def apply_events():
+        # We need our own connection since this is on a different thread
+        db = connect_db()
+        while True:
+            time.sleep(_EVENT_DELAY / 2)
+
+            now = time.monotonic()
+            with pending_lock:
+                ready = [(xmpf, event) for xmpf, (event, first, last) in pending.items()
+                    if now - last >= _EVENT_DELAY or now - first >= _EVENT_MAX_DELAY][:_EVENT_BATCH]
+                for xmpf, _ in ready: del pending[xmpf]
+            if not ready: continue
 
-        @property
-        def db(self):
-            if self._db: return self._db
-            self._db = connect_db()
-            return self._db
+            log.debug("Applying events for %d files", len(ready))
+            try:
+                failed = _apply_file_events(ready, db)
+            except Exception as e:
+                # The whole transaction is gone, e.g. when the database stayed locked
+                log.error("Applying events for %d files failed: %s", len(ready), e)
+                db.rollback()
+                failed = [event for _, event in ready]
+            for event in failed:
+                log.warning("Adding %s to backlog", event)
+                event_queue.put(event)
+
+    event_applier = Thread(target = apply_events)
+    event_applier.name = "Thread to apply filesystem events"
+    event_applier.daemon = True
+    event_applier.start()
 
+    class EventHandler(FileSystemEventHandler):
         def on_any_event(self, event):
             if config.trace_debug:
                 log.debug("%s %r %r", type(event), getattr(event, "src_path", None), getattr(event, "dest_path", None))
 
-        @staticmethod
-        def is_xmp_file(file: Path, is_file = True):
-            if is_file and not file.is_file(): return False
-            if file.suffix != ".xmp": return False
-            if file.name.startswith("."): return False
-            try:
-                UUID(file.stem)
-                return True
-            except: return False
+        def add(self, file, event):
+            file = Path(file)
+            if not _is_xmp_file(file): return
+
+            now = time.monotonic()
+            with pending_lock:
+                _, first, _ = pending.get(file, (None, now, None))
+                pending[file] = (event, first, now)
 
         def on_moved(self, event):
-            self.on_deleted(FileDeletedEvent(event.src_path))
-            self.on_created(FileCreatedEvent(event.dest_path))
+            self.add(event.src_path, FileDeletedEvent(event.src_path))
+            self.add(event.dest_path, FileCreatedEvent(event.dest_path))
 
         def on_created(self, event):
-            file = Path(event.src_path)
-            if not self.is_xmp_file(file): return
-
-            retry(lambda: load_file(file, db = self.db), event)
+            self.add(event.src_path, event)
         
         def on_deleted(self, event):
-            file = Path(event.src_path)
-            if not self.is_xmp_file(file, is_file = False): return
-
-            try:
-                uid = UUID(file.stem)
-            except: return
-            retry(lambda: remove_image(uid, db = self.db), event)
+            self.add(event.src_path, event)
 
         def on_modified(self, event):
-            file = Path(event.src_path)
-            if not self.is_xmp_file(file): return
-
-            retry(lambda: save_file(file, db = self.db), event)
+            self.add(event.src_path, event)
 
     file_observer = Observer()
     watch = file_observer.schedule(EventHandler(), str(config.image_folder.resolve()))
@@ -264,43 +510,79 @@ def listen_for_file_changes():
     file_observer.setDaemon(True)
     file_observer.start()
 
-def listen_for_db_changes():
-    last_updated = datetime.utcfromtimestamp(os.path.getmtime(config.metadbf.resolve()))
-    # We need our own connection since this is on a different thread
-    db = connect_db()
+# Uids whose file might be older than the database. Every uid always goes to the same writer
+# so that two writers never write the same file, the queues drop uids that are queued already.
+_WRITERS = 2
+__dirty = [OrderedSetQueue() for _ in range(_WRITERS)]
+__writers_running = False
+
+def _mark_dirty(uids):
+    """ Queues the files of uids to be written, only call this after the changes were committed """
+    for uid in uids:
+        __dirty[uid.int % _WRITERS].put(uid)
+
+def _write_file(uid: UUID, db: sqlite3.Connection):
+    """ Writes the database entry of uid to its file if the database is newer """
+    data = db.execute("select * from Metadata where uid is ?", (uid,)).fetchone()
+    if not data: return # removed since
+    try: filename = xmp_file_for_uid(uid)
+    except FileNotFoundError: return # the file listener removes it
+
+    stat = _file_stat(filename) # before reading, a change while reading gets picked up by the file listener
+    meta = CuteMeta.from_file(filename)
+
+    f_last_updated = meta.last_updated
+    db_last_updated = data["last_updated"]
+    if db_last_updated > f_last_updated:
+        log.info("Writing to file %r", str(filename))
+        log.debug("file: %s database: %s", f_last_updated, db_last_updated)
+
+        for name, v in zip(data.keys(), data):
+            if name in _FILE_COLUMNS: continue
+            setattr(meta, name, v)
+
+        meta.keywords = set(_keywords_for_uid(uid, db))
+        meta.collections = set(c[0] for c in db.execute("""
+            select collection from Metadata_Collections where uid is ?
+        """, (uid,)))
+        meta.last_updated = db_last_updated # Make sure that the entry in the database stays the same as the file
+        meta.write()
+        stat = _file_stat(filename)
+
+    # The file is in sync now, this keeps the file listener from reading it again
+    _set_file_stat(uid, stat, db)
+    db.commit()
+
+def _write_dirty(dirty: OrderedSetQueue, db: sqlite3.Connection):
     while True:
-        time.sleep(10)
-        
-        modified = db.execute("""
-            select * from Metadata where last_updated > ?
-        """, (last_updated,)).fetchall()
-        last_updated = datetime.utcnow()
-
-        for data in modified:
-            with __lock:
-                filename = xmp_file_for_uid(data["uid"])
-                meta = CuteMeta.from_file(filename)
-
-                f_last_updated = meta.last_updated
-                db_last_updated = data["last_updated"]
-                if db_last_updated > f_last_updated:
-                    log.info("Writing to file %r", str(filename))
-                    log.debug("file: %s database: %s", f_last_updated, db_last_updated)
-
-                    for name, v in zip(data.keys(), data):
-                        setattr(meta, name, v)
-
-                    keywords = db.execute("""
-                        select keyword from Metadata_Keywords where uid = ?
-                    """, (data["uid"],)).fetchmany()
-                    collections = db.execute("""
-                        select collection from Metadata_Collections where uid = ?
-                    """, (data["uid"],)).fetchmany()
-
-                    meta.keywords = set(k[0] for k in keywords)
-                    meta.collections = set(c[0] for c in collections)
-                    meta.last_updated = db_last_updated # Make sure that the entry in the database stays the same as the file
-                    meta.write()
+        try: uid = dirty.get_nowait()
+        except queue.Empty: return
+        _write_queued(uid, dirty, db)
+
+def _write_queued(uid: UUID, dirty: OrderedSetQueue, db: sqlite3.Connection):
+    try:
+        _write_file(uid, db)
+    except Exception as e:
+        log.warning("Writing file for %s failed: %s", uid, e)
+        db.rollback()
+    finally:
+        dirty.task_done()
+
+def start_writers():
+    global __writers_running
+
+    def write_files(dirty):
+        # We need our own connection since this is on a different thread
+        db = connect_db()
+        while True:
+            _write_queued(dirty.get(), dirty, db)
+
+    for n, dirty in enumerate(__dirty):
+        writer = Thread(target = write_files, args = (dirty,))
+        writer.name = f"File writer {n}"
+        writer.daemon = True
+        writer.start()
+    __writers_running = True
 
 def xmp_file_for_uid(uid) -> Path:
     if isinstance(uid, str):
@@ -327,48 +609,62 @@ def query(
     keyword = None, not_keyword = None,
     author = None, caption = None, source = None,
     rating = None,
-    limit = None, random = False,
-    db: sqlite3.Connection = None, **kwargs) -> list:
-
-    all_uids = OrderedSet(get_all_uids(db = db, random = random))
-    uids = OrderedSet(all_uids)
-
-    def select_keywords(keywords):
-        return set(d[0] for d in db.execute(
-            f"select uid from Metadata_Keywords where keyword in ({','.join('?' for k in keywords)})", 
-            tuple(keywords)))
+    limit = None, random = False, count = False,
+    db: sqlite3.Connection = None, **kwargs):
+    """
+    returns a list of uids that match all the filters, ordered by uid or randomly.
+    keyword matches images with any of the keywords, not_keyword removes images with any of them.
+    The other filters are patterns for like, an empty string matches missing values.
+    If count is set, only the number of results is returned.
+    """
+
+    where = []
+    params = []
+
+    def select_keywords(keywords, negate = False):
+        where.append(f"""{'not ' if negate else ''}exists (
+            select 1 from Metadata_Keywords join Keywords on id = keyword_id
+            where Metadata_Keywords.uid = Metadata.uid and name in ({','.join('?' for k in keywords)})
+        )""")
+        params.extend(keywords)
 
     def select_single(name, value):
-        return set(d[0] for d in db.execute(
-            f"select uid from Metadata where {name} {'is' if value == '' else 'like'} ?", (value or None,)
-        ))
+        where.append(f"{name} {'is' if value == '' else 'like'} ?")
+        params.append(value or None)
 
     if author is not None:
-        uids &= select_single("author", author)
+        select_single("author", author)
     if caption is not None:
-        uids &= select_single("caption", caption)
+        select_single("caption", caption)
     if source is not None:
-        uids &= select_single("source", source)
+        select_single("source", source)
     if rating is not None:
-        uids &= select_single("rating", rating)
+        select_single("rating", rating)
 
-    if keyword: 
-        uids &= select_keywords(keyword)
+    if keyword:
+        select_keywords(keyword)
     if not_keyword:
-        uids &= all_uids - select_keywords(not_keyword)
+        select_keywords(not_keyword, negate = True)
 
-    if limit and len(uids) > limit:
-        return list(uids)[:limit]
-    return list(uids)
+    sql = "select uid from Metadata"
+    if where:
+        sql += " where " + " and ".join(where)
+    sql += " order by " + ("random()" if random else "uid")
+    if limit:
+        sql += " limit ?"
+        params.append(limit)
+
+    if count:
+        return db.execute(f"select count(*) from ({sql})", params).fetchone()[0]
+    return [d[0] for d in db.execute(sql, params)]
 
 @dbfun
 def get_tab_complete_keywords(keywordstr: str = None, db: sqlite3.Connection = None) -> set:
-    keywords = db.execute("select distinct keyword from Metadata_Keywords where keyword like ? order by keyword", ((keywordstr if keywordstr else "") + "%",)).fetchall()
-    return set(keyword[0] for keyword in keywords)
+    return set(__keywords.prefixed(keywordstr or ""))
 
 @dbfun
 def get_uids_from_keyword(keyword: str, db: sqlite3.Connection = None) -> set:
-    uids = db.execute("select uid from Metadata_Keywords where keyword like ? order by keyword", (keyword,)).fetchall()
+    uids = db.execute("select uid from Metadata_Keywords join Keywords on id = keyword_id where name like ? order by name", (keyword,)).fetchall()
     return set(uid[0] for uid in uids)
 
 @dbfun
@@ -380,13 +676,49 @@ def get_uids_from_keyword_list(keywords, db: sqlite3.Connection = None) -> set:
 
     return ret_uids
 
+# Columns of the full text index that column:word can search on their own
+_SEARCH_COLUMNS = ("caption", "author", "source", "keywords")
+
+def _search_query(text: str) -> str:
+    """ Turns words into prefix searches and keeps "quoted phrases" as they are, column:word only searches that column """
+    terms = []
+    for column, phrase, word in re.findall(r'(?:(\w+):)?(?:"([^"]*)"|(\S+))', text):
+        if column and column not in _SEARCH_COLUMNS:
+            # Just a word with a colon, like the namespace of a keyword
+            phrase, word = "", f'{column}:"{phrase}"' if phrase else f"{column}:{word}"
+        if phrase: term = '"%s"' % phrase
+        elif word: term = '"%s"*' % word.replace('"', '""')
+        else: continue
+        terms.append(f"{column} : {term}" if column in _SEARCH_COLUMNS else term)
+    return " ".join(terms)
+
+@dbfun
+def search(text: str, limit = None, raw = False, db: sqlite3.Connection = None) -> list:
+    """
+    Full text search over caption, author, source and keywords, returns a list of uids with the best matches first.
+    Every word needs to match the start of a word, "quoted phrases" need to match as a whole.
+    column:word and column:"phrase" only search one of caption, author, source or keywords.
+    If raw is set, text is passed on as an FTS5 query.
+    """
+    match = text if raw else _search_query(text)
+    if not match: return []
+
+    sql = """
+        SELECT uid FROM Metadata_Search JOIN Metadata_Search_Rows ON Metadata_Search_Rows.id = Metadata_Search.rowid
+        WHERE Metadata_Search MATCH ? ORDER BY bm25(Metadata_Search)
+    """
+    params = [match]
+    if limit:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return [d[0] for d in db.execute(sql, params)]
+
 @dbfun
 def get_tab_complete_uids(uidstr: str, db: sqlite3.Connection = None) -> set:
     """ Returns a list of tab completions for a starting uid """
 
     uidstr = uidstr.replace("-", "")
-    uids = db.execute("select uid from Metadata where uid like ?", (uidstr + "%",)).fetchall()
-    return set(uid[0] for uid in uids)
+    return set(UUID(hex = uid) for uid in __uids.prefixed(uidstr))
 
 @dbfun
 def get_random_uid(db: sqlite3.Connection = None):
@@ -400,18 +732,51 @@ def get_all_uids(db: sqlite3.Connection = None, random = False) -> list:
 
 @dbfun
 def get_meta(uid: UUID, db: sqlite3.Connection = None):
-    meta = CuteMeta(uid = uid, filename = xmp_file_for_uid(uid))
-    uidstr = str(uid.hex)
-    res = db.execute("select * from Metadata where uid is ?", (uidstr,)).fetchone()
-    for name, v in zip(res.keys(), res):
-        setattr(meta, name, v)
-
-    keywords = db.execute("select keyword from Metadata_Keywords where uid is ?", (uidstr,)).fetchall()
-    meta.keywords = set(k[0] for k in keywords) if keywords else None
-    collections = db.execute("select collection from Metadata_Collections where uid is ?", (uidstr,)).fetchall()
-    meta.collections = set(c[0] for c in collections) if collections else None
+    xmp_file_for_uid(uid) # raises if the file is gone
+    return _get_metas([uid], None, db)[uid]
 
-    return meta
+@dbfun
+def get_metas(uids, fields = None, db: sqlite3.Connection = None) -> dict:
+    """
+    get_meta for many uids at once, returns a dict with the meta of every uid that exists.
+    fields is a list of tag names, the other tags are left empty.
+    """
+    return _get_metas(uids, fields, db)
+
+def _get_metas(uids, fields, db: sqlite3.Connection) -> dict:
+    uids = list(dict.fromkeys(uids))
+    tags = set(fields or CuteMeta.tag_names())
+    columns = ["uid"] + [
+        "author" if tag == "authors" else tag for tag in CuteMeta.tag_names()
+        if tag in tags and tag not in ("uid", "keywords", "collections")
+    ]
+
+    metas = {}
+    for i in range(0, len(uids), 500):
+        chunk = uids[i:i + 500]
+        params = ",".join("?" for _ in chunk)
+
+        for res in db.execute(f"select {', '.join(columns)} from Metadata where uid in ({params})", chunk):
+            meta = CuteMeta(uid = res["uid"], filename = (config.image_folder / str(res["uid"])).with_suffix(".xmp"))
+            for name, v in zip(res.keys(), res):
+                setattr(meta, name, v)
+            metas[meta.uid] = meta
+
+        if "keywords" in tags:
+            for uid, name in db.execute(f"""
+                select uid, name from Metadata_Keywords join Keywords on id = keyword_id where uid in ({params})
+            """, chunk):
+                meta = metas[uid]
+                if meta.keywords is None: meta.keywords = set()
+                meta.keywords.add(name)
+        if "collections" in tags:
+            for uid, collection in db.execute(f"select uid, collection from Metadata_Collections where uid in ({params})", chunk):
+                meta = metas[uid]
+                if meta.collections is None: meta.collections = set()
+                meta.collections.add(collection)
+
+    # Same order as uids
+    return {uid: metas[uid] for uid in uids if uid in metas}
 
 @dbfun
 def remove_image(uid: UUID, db: sqlite3.Connection = None):
@@ -428,47 +793,58 @@ def _remove_image(uid: UUID, db: sqlite3.Connection):
         SELECT count(uid) FROM Metadata where hash = ?
     """, (imghash,)).fetchone()[0]
     
+    _index_keywords(db, discard = _keywords_for_uid(uid, db))
+    _index_uids(db, discard = [uid.hex])
+
     db.execute("DELETE FROM Metadata_Keywords WHERE uid = ?", (uid,))
     db.execute("DELETE FROM Metadata_Collections WHERE uid = ?", (uid,))
     db.execute("DELETE FROM Metadata WHERE uid = ?", (uid,))
+    _remove_search(uid, db)
 
-    if cnthash == 1:
-        with __lock:
-            try: __hashes.remove(imghash) # Only one hash by this name, it doesnt exist anymore now
-            except KeyError: pass
+    if cnthash == 1: # Only one hash by this name, it doesnt exist anymore now
+        _index_hashes(db, discard = [imghash])
 
 @dbfun
 def save_file(fp: Path, db: sqlite3.Connection = None):
-    _save_file(fp, db)
+    dirty = _save_file(fp, db)
     db.commit()
+    if dirty: _mark_dirty([UUID(fp.stem)])
 
-def _save_file(xmpf: Path, db: sqlite3.Connection):
+def _save_file(xmpf: Path, db: sqlite3.Connection) -> bool:
+    """ returns True if the database is newer than the file afterwards """
     with __lock:
+        uid = UUID(xmpf.stem)
+        stat = _file_stat(xmpf) # before reading, a change while reading gets picked up next time
+        db_last_updated, *db_stat = db.execute("""
+            select last_updated, file_size, file_mtime from Metadata where uid is ?
+        """, (uid,)).fetchone()
+        if tuple(db_stat) == stat: return False # Unchanged since the last sync
+
         meta = CuteMeta.from_file(xmpf)
         f_last_updated = meta.last_updated
-        uid = UUID(xmpf.stem)
-        db_last_updated = db.execute("""
-            select last_updated from Metadata where uid is ?
-        """, (uid,)).fetchone()[0]
         
         if f_last_updated > db_last_updated:
             log.info("Reading from file %r", str(xmpf))
             log.debug("file: %s database: %s", f_last_updated, db_last_updated)
-            _save_meta(meta, f_last_updated, db)
-            db.commit()
+            db_last_updated = _save_meta(meta, f_last_updated, db)
+        _set_file_stat(uid, stat, db)
+        return db_last_updated > f_last_updated
 
 @dbfun
 def save_meta(meta: CuteMeta, db: sqlite3.Connection = None):
     _save_meta(meta, datetime.utcnow(), db)
     db.commit()
+    _mark_dirty([meta.uid])
 
-def _save_meta(meta: CuteMeta, timestamp: datetime, db: sqlite3.Connection):
+def _save_meta(meta: CuteMeta, timestamp: datetime, db: sqlite3.Connection) -> datetime:
+    """ returns the timestamp that got stored """
 
     # Sync data
     if meta.generate_keywords():
         log.info("Updated autogenerated keywords")
         timestamp = datetime.utcnow() # make sure we set the correct timestamp
 
+    _index_keywords(db, discard = _keywords_for_uid(meta.uid, db))
     db.execute("""
         DELETE FROM Metadata_Keywords WHERE uid is ?
     """, (meta.uid,))
@@ -477,11 +853,7 @@ def _save_meta(meta: CuteMeta, timestamp: datetime, db: sqlite3.Connection):
     """, (meta.uid,))
 
     if meta.keywords:
-        db.executemany(f"""
-            INSERT INTO Metadata_Keywords VALUES (
-                ?, ?
-            ) 	
-        """, [(meta.uid, keyword) for keyword in meta.keywords])
+        _insert_keywords([(meta.uid, keyword) for keyword in meta.keywords], db)
     if meta.collections:
         db.executemany(f"""
             INSERT INTO Metadata_Collections VALUES (
@@ -515,6 +887,82 @@ def _save_meta(meta: CuteMeta, timestamp: datetime, db: sqlite3.Connection):
 
         meta.uid
     ))
+    _update_search([meta.uid], db)
+    return timestamp
+
+# Columns that set_field can change for many images at once
+BULK_FIELDS = ("caption", "author", "source", "group_id", "rating", "date", "source_other", "source_via")
+_NOT_NULL_FIELDS = ("date",)
+
+@dbfun
+def add_keywords(uids, keywords, db: sqlite3.Connection = None):
+    """ Adds the keywords to every image in uids with one transaction """
+    _bulk_edit(uids, lambda uids: _add_keywords(uids, keywords, db), db)
+
+@dbfun
+def remove_keywords(uids, keywords, db: sqlite3.Connection = None):
+    """ Removes the keywords from every image in uids with one transaction """
+    _bulk_edit(uids, lambda uids: _remove_keywords(uids, keywords, db), db)
+
+@dbfun
+def set_field(uids, field: str, value, db: sqlite3.Connection = None):
+    """ Sets one of BULK_FIELDS to value for every image in uids with one transaction """
+    if field not in BULK_FIELDS:
+        raise ValueError("Can't set %r for many images" % field)
+    if value is None and field in _NOT_NULL_FIELDS:
+        raise ValueError("%s can't be empty" % field)
+
+    def edit(uids):
+        db.executemany(f"UPDATE Metadata SET {field} = ? WHERE uid is ?", [(value, uid) for uid in uids])
+
+        # Same as CuteMeta.generate_keywords
+        if field in ("caption", "author", "source", "rating"):
+            if value: _remove_keywords(uids, ["missing:" + field], db)
+            else: _add_keywords(uids, ["missing:" + field], db)
+        if field == "author" and value:
+            _add_keywords(uids, ["author:" + value], db)
+
+    _bulk_edit(uids, edit, db)
+
+def _bulk_edit(uids, edit, db: sqlite3.Connection):
+    """ Calls edit with the uids that exist, updates their timestamp and queues their files to be written """
+    with __lock:
+        uids = _existing_uids(uids, db)
+        try:
+            edit(uids)
+            db.executemany("UPDATE Metadata SET last_updated = ? WHERE uid is ?", [(datetime.utcnow(), uid) for uid in uids])
+            _update_search(uids, db)
+        except:
+            db.rollback()
+            raise
+        db.commit()
+    _mark_dirty(uids)
+
+def _existing_uids(uids, db: sqlite3.Connection) -> list:
+    uids = list(set(uids))
+    existing = []
+    for i in range(0, len(uids), 500):
+        chunk = uids[i:i + 500]
+        existing.extend(d[0] for d in db.execute(f"select uid from Metadata where uid in ({','.join('?' for _ in chunk)})", chunk))
+    return existing
+
+def _uids_with_keyword(keyword: str, db: sqlite3.Connection) -> set:
+    return set(d[0] for d in db.execute("""
+        select uid from Metadata_Keywords where keyword_id = (select id from Keywords where name = ?)
+    """, (keyword,)))
+
+def _add_keywords(uids, keywords, db: sqlite3.Connection):
+    for keyword in set(keywords):
+        tagged = _uids_with_keyword(keyword, db)
+        _insert_keywords([(uid, keyword) for uid in uids if uid not in tagged], db)
+
+def _remove_keywords(uids, keywords, db: sqlite3.Connection):
+    for keyword in set(keywords):
+        tagged = _uids_with_keyword(keyword, db).intersection(uids)
+        db.executemany("""
+            DELETE FROM Metadata_Keywords WHERE uid is ? and keyword_id = (select id from Keywords where name = ?)
+        """, [(uid, keyword) for uid in tagged])
+        _index_keywords(db, discard = [keyword] * len(tagged))
 
 @dbfun
 def load_file(xmpf, db: sqlite3.Connection):
@@ -522,6 +970,15 @@ def load_file(xmpf, db: sqlite3.Connection):
     db.commit()
 
 def _load_file(xmpf: Path, db: sqlite3.Connection):
+    row = _read_file(xmpf)
+    if row: _insert_rows([row], db)
+
+def _read_file(xmpf: Path):
+    """
+    Reads an xmp file into a tuple that can be inserted with _insert_rows, None if it can't be loaded.
+    Only uses plain values so that it can run in a process pool.
+    """
+    stat = _file_stat(xmpf)
     meta: CuteMeta = CuteMeta.from_file(xmpf)
     timestamp = meta.last_updated
 
@@ -535,16 +992,9 @@ def _load_file(xmpf: Path, db: sqlite3.Connection):
         log.info("Updated autogenerated keywords")
         timestamp = datetime.utcnow() # make sure we set the correct timestamp 
 
-    with __lock:
-        try: __hashes.add(meta.hash)
-        except KeyError: log.warn("Possible duplicate %r", str(xmpf))
-
-    db.execute(f"""
-        INSERT INTO Metadata (
-            last_updated, uid, hash, caption, author, source, group_id, rating, source_other, source_via
-        ) VALUES (
-            ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
-        )""", (
+    return (
+        str(xmpf),
+        (
             timestamp,
             meta.uid,
             meta.hash, 
@@ -554,35 +1004,139 @@ def _load_file(xmpf: Path, db: sqlite3.Connection):
             meta.group_id,
             meta.rating, 
             meta.source_other, 
-            meta.source_via
-        )
+            meta.source_via,
+            meta.date,
+            *stat
+        ),
+        meta.keywords,
+        meta.collections
     )
-    if meta.date:
-        db.execute("""
-            UPDATE Metadata SET date = ? WHERE uid is ?
-        """, (meta.date, meta.uid))
 
-    if meta.keywords:
-        db.executemany(f"""
-            INSERT INTO Metadata_Keywords VALUES (
-                ?, ?
-            ) 	
-        """, [(meta.uid, keyword) for keyword in meta.keywords])
-    if meta.collections:
-        db.executemany(f"""
-            INSERT INTO Metadata_Collections VALUES (
-                ?, ?
-            ) 	
-        """, [(meta.uid, collection) for collection in meta.collections])
+def _insert_rows(rows, db: sqlite3.Connection):
+    _index_hashes(db, add = [(values[2], xmpf) for xmpf, values, _, _ in rows])
+
+    db.executemany(f"""
+        INSERT INTO Metadata (
+            last_updated, uid, hash, caption, author, source, group_id, rating, source_other, source_via, date, file_size, file_mtime
+        ) VALUES (
+            ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, COALESCE(?, strftime('%Y-%m-%d %H:%M:%f', 'now')), ?, ?
+        )""", [values for _, values, _, _ in rows]
+    )
+    _insert_keywords([(values[1], keyword) for _, values, keywords, _ in rows for keyword in keywords or ()], db)
+    _update_search([values[1] for _, values, _, _ in rows], db)
+    _index_uids(db, add = [values[1].hex for _, values, _, _ in rows])
+    db.executemany(f"""
+        INSERT INTO Metadata_Collections VALUES (
+            ?, ?
+        ) 	
+    """, [(values[1], collection) for _, values, _, collections in rows for collection in collections or ()])
+
+# Values for the full text index of every image
+_SEARCH_SELECT = """
+    SELECT Metadata_Search_Rows.id, caption, author, source, (
+        SELECT group_concat(name, ' ') FROM Metadata_Keywords JOIN Keywords ON id = keyword_id
+        WHERE Metadata_Keywords.uid = Metadata.uid
+    )
+    FROM Metadata JOIN Metadata_Search_Rows USING (uid)
+"""
+
+def _update_search(uids, db: sqlite3.Connection):
+    """ Replaces the full text index of the uids with their current metadata """
+    uids = [(uid,) for uid in uids]
+    db.executemany("INSERT INTO Metadata_Search_Rows (uid) VALUES (?) ON CONFLICT (uid) DO NOTHING", uids)
+    db.executemany("DELETE FROM Metadata_Search WHERE rowid = (SELECT id FROM Metadata_Search_Rows WHERE uid = ?)", uids)
+    db.executemany(f"INSERT INTO Metadata_Search (rowid, caption, author, source, keywords) {_SEARCH_SELECT} WHERE uid = ?", uids)
+
+def _remove_search(uid: UUID, db: sqlite3.Connection):
+    db.execute("DELETE FROM Metadata_Search WHERE rowid = (SELECT id FROM Metadata_Search_Rows WHERE uid = ?)", (uid,))
+    db.execute("DELETE FROM Metadata_Search_Rows WHERE uid = ?", (uid,))
+
+def _keywords_for_uid(uid: UUID, db: sqlite3.Connection) -> list:
+    return [k[0] for k in db.execute("select name from Metadata_Keywords join Keywords on id = keyword_id where uid is ?", (uid,))]
+
+def _insert_keywords(keywords, db: sqlite3.Connection):
+    """ keywords is a list of (uid, keyword) """
+    db.executemany("""
+        INSERT INTO Keywords (name) VALUES (?) ON CONFLICT (name) DO NOTHING
+    """, set((keyword,) for _, keyword in keywords))
+    db.executemany("""
+        INSERT INTO Metadata_Keywords SELECT ?, id FROM Keywords WHERE name = ?
+    """, keywords)
+    _index_keywords(db, add = [keyword for _, keyword in keywords])
+
+def _index_hashes(db: sqlite3.Connection, add = (), discard = ()):
+    """ Changes the similarity index once the transaction is committed, add is a list of (hash, file) """
+    def update():
+        with __hashes_lock.write():
+            for h, xmpf in add:
+                try: __hashes.add(h)
+                except KeyError: log.warning("Possible duplicate %r", xmpf)
+            for h in discard:
+                try: __hashes.remove(h)
+                except KeyError: pass
+    db.on_commit.append(update)
+
+def _index_keywords(db: sqlite3.Connection, add = (), discard = ()):
+    """ Changes the keyword counts for tab completion once the transaction is committed """
+    def update():
+        for keyword in add: __keywords.add(keyword)
+        for keyword in discard: __keywords.discard(keyword)
+    db.on_commit.append(update)
+
+def _index_uids(db: sqlite3.Connection, add = (), discard = ()):
+    """ Changes the uids for tab completion once the transaction is committed """
+    def update():
+        for uid in add: __uids.add(uid)
+        for uid in discard: __uids.discard(uid)
+    db.on_commit.append(update)
+
+def _load_folder(files, db: sqlite3.Connection, workers = None):
+    """ Loads many xmp files at once, the files get parsed in a process pool and are inserted in large transactions """
+    from concurrent.futures import ProcessPoolExecutor
+
+    files = list(files)
+    if workers is None: workers = os.cpu_count()
+    progress = log_progress("Loading files")
+
+    def insert(rows):
+        batch = []
+        for n, row in enumerate(rows):
+            if row: batch.append(row)
+            if len(batch) >= 1000:
+                _insert_rows(batch, db)
+                db.commit()
+                batch = []
+                progress(n + 1, len(files))
+        _insert_rows(batch, db)
+        db.commit()
+        progress(len(files), len(files))
+
+    if workers > 1 and len(files) >= 100:
+        with ProcessPoolExecutor(workers) as executor:
+            insert(executor.map(_read_file, files, chunksize = 64))
+    else:
+        insert(map(_read_file, files))
+
+def __find_uids_for_hashes(hashes, db: sqlite3.Connection) -> dict:
+    """ returns a dict with the uids for every hash """
+    ret = {}
+    hashes = [format(h, "0%dx" % ceil(config.hash_length / 4)) for h in hashes]
+    for i in range(0, len(hashes), 500):
+        chunk = hashes[i:i + 500]
+        res = db.execute(f"select uid, hash from Metadata where hash in ({','.join('?' for h in chunk)})", chunk)
+        for uid, h in res:
+            ret.setdefault(int(h, 16), []).append(uid)
+    return ret
+
+def __collect_uids_with_hashes(hashes, db: sqlite3.Connection, uids = None):
+    if uids is None:
+        uids = __find_uids_for_hashes(set(h for _, h in hashes), db)
 
-def __collect_uids_with_hashes(hashes, db: sqlite3.Connection):
     ret = []
-    if hashes:
-        for similarity, h in hashes:
-            similarity = 1 - (similarity / config.hash_length)
-            res = db.execute("select uid from Metadata where hash is ?", (format(h, "x"),)).fetchall()
-            for r in res:
-                ret.append((similarity, r[0]))
+    for similarity, h in hashes:
+        similarity = 1 - (similarity / config.hash_length)
+        for uid in uids.get(h, ()):
+            ret.append((similarity, uid))
 
     return sorted(ret, reverse = True)
 
@@ -593,23 +1147,42 @@ def find_similar_images_hash(h: str, threshold: float, limit = 10, db: sqlite3.C
     if limit > 100: limit = 100
     if limit < 1: limit = 1
 
-    found = False
     distance = ceil(config.hash_length * (1 - threshold))
 
     hashes = []
-    with __lock:
-        # First see if the hash is inside there already
+    with __hashes_lock.read():
+        # The search skips the hash itself
         if h in __hashes: 
-            found = True
             hashes.append((0, int(h, 16)))
-            
-        else: __hashes.add(h) # Need to add it temporarily
         
         hashes += __hashes.find_all_hamming_distance(h, distance, limit)
-        if not found: __hashes.remove(h)
 
     return __collect_uids_with_hashes(hashes, db)
 
+@dbfun
+def find_similar_images_batch(hashes, threshold: float, limit = 10, db: sqlite3.Connection = None) -> dict:
+    """ find_similar_images_hash for many hashes at once, returns a dict with the results for every hash """
+
+    assert 0 <= threshold <= 1
+    if limit > 100: limit = 100
+    if limit < 1: limit = 1
+
+    distance = ceil(config.hash_length * (1 - threshold))
+    keys = {h: int(h, 16) if isinstance(h, str) else h for h in hashes}
+
+    with __hashes_lock.read():
+        found = __hashes.find_all_hamming_distance_batch(keys.values(), distance, limit)
+        exact = set(key for key in keys.values() if key in __hashes)
+
+    uids = __find_uids_for_hashes(set(h for result in found.values() for _, h in result) | exact, db)
+
+    ret = {}
+    for h, key in keys.items():
+        hashes = list(found[key])
+        if key in exact: hashes.append((0, key))
+        ret[h] = __collect_uids_with_hashes(hashes, db, uids)
+    return ret
+
 @dbfun
 def find_similar_images(uid: UUID, threshold: float, limit = 10, db: sqlite3.Connection = None):
     """ returns a list of uids for similar images for an image/uid """
@@ -620,7 +1193,7 @@ def find_similar_images(uid: UUID, threshold: float, limit = 10, db: sqlite3.Con
 
     meta = get_meta(uid, db = db)
     distance = ceil(config.hash_length * (1 - threshold))
-    with __lock:
+    with __hashes_lock.read():
         hashes = __hashes.find_all_hamming_distance(meta.hash, distance, limit)
 
     return __collect_uids_with_hashes(hashes, db)
@@ -638,3 +1211,44 @@ def find_all_duplicates(db: sqlite3.Connection = None):
     for h, in res:
         ret.append(find_uids_with_hash(h, db = db))
     return ret
+
+@dbfun
+def get_all_hashes(db: sqlite3.Connection = None) -> dict:
+    """ returns a dict with the uids for every hash """
+    ret = {}
+    for uid, h in db.execute("select uid, hash from Metadata where hash is not NULL"):
+        ret.setdefault(int(h, 16), []).append(uid)
+    return ret
+
+def find_all_near_duplicates(threshold: float, workers = None) -> list:
+    """
+    Clusters all images that are connected by a similarity of at least threshold.
+    returns a list of sets of uids, biggest clusters first.
+    The pair search runs in this process with a pool of workers, not in the database service.
+    """
+
+    from cutespam.multiindex import find_all_pairs
+
+    assert 0 <= threshold <= 1
+    distance = ceil(config.hash_length * (1 - threshold))
+    hashes = get_all_hashes()
+
+    # Union find over the hashes
+    parents = {}
+    def find(h):
+        root = h
+        while parents.get(root, root) != root:
+            root = parents[root]
+        while h != root:
+            parents[h], h = root, parents[h]
+        return root
+
+    for _, a, b in find_all_pairs(hashes.keys(), config.hash_length, distance, workers):
+        a, b = find(a), find(b)
+        if a != b: parents[max(a, b)] = min(a, b)
+
+    clusters = {}
+    for h, uids in hashes.items():
+        clusters.setdefault(find(h), set()).update(uids)
+
+    return sorted((c for c in clusters.values() if len(c) > 1), key = len, reverse = True)
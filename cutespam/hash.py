@@ -1,10 +1,181 @@
-import atexit, io
+import atexit, io, os, sqlite3, time
 from PIL import Image
 from imagehash import phash
 from lzma import LZMAFile
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from pathlib import Path
+from threading import Lock
 
+from cutespam import log
+from cutespam.config import config
 from cutespam.hashtree import HashTree
 
-def hash_img(fp): 
+HASH_SIZE = 16
+HASH_IMG_SIZE = HASH_SIZE * 4 # phash scales the image down to this before the DCT
+
+class HashCache:
+    """
+    Remembers the hashes of files by their path, size and modification time
+    so that unchanged files don't need to be decoded again.
+    Keeps the max_size entries that were used last. When an entry was used is kept in memory
+    and only written once the cache gets evicted or closed, so that a hit doesn't need a write.
+    """
+
+    # Number of hits that are kept in memory before they get written
+    _MAX_USED = 10_000
+
+    def __init__(self, file, max_size):
+        self.max_size = max_size
+        self._lock = Lock()
+        self._inserts = 0
+        self._used = {} # path -> last used
+        self._db = sqlite3.connect(str(file), timeout = 30, check_same_thread = False, isolation_level = None)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS HashCache (
+                path TEXT PRIMARY KEY NOT NULL,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                hash TEXT NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS HashCache_last_used ON HashCache (last_used)")
+
+    @staticmethod
+    def _key(fp):
+        fp = Path(fp).resolve()
+        stat = fp.stat()
+        return str(fp), stat.st_size, stat.st_mtime_ns
+
+    def get(self, fp):
+        path, size, mtime = self._key(fp)
+        with self._lock:
+            res = self._db.execute("select hash from HashCache where path is ? and size is ? and mtime is ?", (path, size, mtime)).fetchone()
+            if not res: return None
+            self._used[path] = time.time()
+            if len(self._used) >= self._MAX_USED: self._write_used()
+            return res[0]
+
+    def _write_used(self):
+        if not self._used: return
+        self._db.execute("BEGIN")
+        self._db.executemany("update HashCache set last_used = ? where path is ?", ((t, path) for path, t in self._used.items()))
+        self._db.execute("COMMIT")
+        self._used = {}
+
+    def put(self, fp, h):
+        path, size, mtime = self._key(fp)
+        with self._lock:
+            self._db.execute("insert or replace into HashCache values (?, ?, ?, ?, ?)", (path, size, mtime, h, time.time()))
+            self._used.pop(path, None)
+
+            # Only check the size every now and then, counting is slow on a big table
+            self._inserts += 1
+            if self._inserts % max(1, min(1000, self.max_size // 100)) == 0:
+                count = self._db.execute("select count(*) from HashCache").fetchone()[0]
+                if count > self.max_size:
+                    self._write_used()
+                    self._db.execute("""
+                        delete from HashCache where path in (
+                            select path from HashCache order by last_used limit ?
+                        )
+                    """, (count - self.max_size,))
+
+    def close(self):
+        with self._lock:
+            self._write_used()
+            self._db.close()
+
+__cache = None
+__cache_lock = Lock()
+
+def hash_cache() -> HashCache:
+    """ returns the HashCache in the cache folder, None if it is disabled """
+    global __cache
+    if config.hash_cache_size <= 0: return None
+    with __cache_lock:
+        if __cache is None:
+            __cache = HashCache(config.hashcachef, config.hash_cache_size)
+            atexit.register(__cache.close)
+    return __cache
+
+def hash_img(fp, draft = False, cache = True):
+    """
+    draft lets the decoder scale down JPEG images while loading them, this is a lot faster
+    for big images but the resulting hashes differ slightly from the ones without it.
+    Hashes of unchanged files are taken from the hash cache if cache is set,
+    hashes with draft never get cached.
+    """
+    cache = hash_cache() if cache and not draft else None
+    if cache:
+        h = cache.get(fp)
+        if h: return h
+
     with Image.open(fp) as img_data:
-        return str(phash(img_data, hash_size = 16))
\ No newline at end of file
+        if draft:
+            img_data.draft("RGB", (HASH_IMG_SIZE, HASH_IMG_SIZE))
+        h = str(phash(img_data, hash_size = HASH_SIZE))
+
+    if cache: cache.put(fp, h)
+    return h
+
+def _hash_file(fp, draft, cache = False):
+    try:
+        return fp, hash_img(fp, draft, cache)
+    except Exception as e:
+        log.warning("Couldn't hash %s: %s", fp, e)
+        return fp, None
+
+def hash_imgs(files, workers = None, draft = False, ordered = False, cache = True):
+    """
+    Hashes the files in a process pool and yields (file, hash) as soon as they are done.
+    The hash is None if the file couldn't be hashed. If ordered is set, the results
+    come in the same order as the files. Only a few files per worker get queued at once
+    so that files can be a generator.
+    The hash cache is only used from this process, cached files don't get sent to the workers.
+    """
+
+    cache = hash_cache() if cache and not draft else None
+
+    if workers is None: workers = os.cpu_count()
+    if workers <= 1:
+        for fp in files:
+            yield _hash_file(fp, draft, cache = bool(cache))
+        return
+
+    from_cache = set()
+    def cached(fp):
+        try: h = cache.get(fp) if cache else None
+        except OSError: h = None # Let the worker report it
+        if not h: return None
+
+        future = Future()
+        future.set_result((fp, h))
+        from_cache.add(future)
+        return future
+
+    def stored(future):
+        fp, h = future.result()
+        if future in from_cache: from_cache.remove(future)
+        elif cache and h: cache.put(fp, h)
+        return fp, h
+
+    with ProcessPoolExecutor(workers) as executor:
+        pending = deque()
+        for fp in files:
+            future = cached(fp) or executor.submit(_hash_file, fp, draft)
+            pending.append(future)
+            if len(pending) < workers * 4: continue
+
+            if ordered:
+                yield stored(pending.popleft())
+            else:
+                done = next(as_completed(pending))
+                pending.remove(done)
+                yield stored(done)
+
+        if ordered:
+            for future in pending: yield stored(future)
+        else:
+            for future in as_completed(pending): yield stored(future)
\ No newline at end of file
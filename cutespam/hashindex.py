@@ -0,0 +1,84 @@
+import mmap, os, struct
+
+from collections.abc import Sequence
+from bisect import bisect_left
+from math import ceil
+from pathlib import Path
+
+# Layout of an index file:
+#   header: magic, version, record size in bytes, number of records
+#   records: big endian hashes padded to a multiple of 64 bits, sorted
+MAGIC = b"CSHI"
+VERSION = 1
+HEADER = struct.Struct("<4sHHQ")
+
+def record_size(hash_length):
+    return ceil(hash_length / 64) * 8
+
+def is_index_file(file) -> bool:
+    with open(file, "rb") as fp:
+        return fp.read(len(MAGIC)) == MAGIC
+
+def write_index(file, keys, hash_length):
+    """
+    Writes the sorted keys to file. The index is written next to the file and moved over it,
+    a crash never leaves half an index and open memory maps keep reading the old one.
+    """
+
+    record = record_size(hash_length)
+    file = Path(file).resolve()
+    tmp = file.with_name(f".{file.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp, "wb") as fp:
+            fp.write(HEADER.pack(MAGIC, VERSION, record, len(keys)))
+            fp.write(b"".join(key.to_bytes(record, byteorder = "big") for key in keys))
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, file)
+    except:
+        try: os.remove(tmp)
+        except FileNotFoundError: pass
+        raise
+
+class HashIndexFile(Sequence):
+    """ Sorted keys of an index file, read in place from a memory mapped file """
+
+    def __init__(self, file, hash_length):
+        self.file = Path(file)
+        with open(self.file, "rb") as fp:
+            self.buffer = mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ)
+
+        magic, version, self.record_size, self._len = HEADER.unpack_from(self.buffer)
+        if magic != MAGIC:
+            raise ValueError("%s is not a hash index" % self.file)
+        if version != VERSION:
+            raise ValueError("Unsupported hash index version %d" % version)
+        if self.record_size != record_size(hash_length):
+            raise ValueError("Hash index was written for a different hash length")
+
+    @property
+    def offset(self):
+        """ Position of the first record """
+        return HEADER.size
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[n] for n in range(*i.indices(self._len))]
+        if i < 0: i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError("index out of range")
+
+        start = HEADER.size + i * self.record_size
+        return int.from_bytes(self.buffer[start:start + self.record_size], byteorder = "big")
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, key):
+        if isinstance(key, str):
+            key = int(key, 16)
+        i = bisect_left(self, key)
+        return i < self._len and self[i] == key
+
+    def close(self):
+        self.buffer.close()
@@ -0,0 +1,215 @@
+import numpy as np
+import os
+
+from collections.abc import MutableSet
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
+from lzma import LZMAFile
+from pathlib import Path
+
+from cutespam.hashtree import _hash_to_int, _write_bitstream, _serialize_keys, _deserialize_keys, _file_progress
+from cutespam.hashindex import HashIndexFile, write_index
+
+# Number of rows that are compared with a block of keys at once, keeps the temporary arrays in cache
+_ROW_BLOCK = 8192
+_KEY_BLOCK = 32
+
+if hasattr(np, "bitwise_count"):
+    def _popcount(matrix):
+        return np.bitwise_count(matrix).sum(axis = -1, dtype = np.int32)
+else:
+    _POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype = np.uint8)
+    def _popcount(matrix):
+        return _POPCOUNT_TABLE[matrix.view(np.uint8)].sum(axis = -1, dtype = np.int32)
+
+def _closest(rows, distances, limit):
+    """ Only keeps the limit closest rows, everything at the cutoff distance is sorted out later """
+    if limit is not None and len(rows) > limit:
+        cutoff = np.partition(distances, limit - 1)[limit - 1]
+        keep = distances <= cutoff
+        rows, distances = rows[keep], distances[keep]
+    return rows, distances
+
+class HashMatrix(MutableSet):
+    """
+    Same interface as HashTree, keeps all hashes in one uint64[N, hash_length / 64] matrix.
+    A hamming search compares against every hash at once, which takes the same time for
+    every distance instead of growing with the number of bits that can be flipped.
+
+    The rows hold the big endian bytes of every hash, so the matrix can use the records
+    of an index file as they are. When read from an index, the matrix stays mapped to the file
+    until it gets modified.
+    """
+
+    def __init__(self, hash_length):
+        """ hash_length in bits """
+        self.hash_length = hash_length
+        self._words = ceil(hash_length / 64)
+        self._matrix = np.zeros((64, self._words), dtype = np.uint64)
+        self._rows = {} # key -> row in the matrix
+        self._keys = [] # row -> key
+        self._index = None # HashIndexFile that backs the matrix
+
+    def _to_row(self, key):
+        return np.frombuffer(key.to_bytes(self._words * 8, byteorder = "big"), dtype = np.uint64)
+
+    def _to_key(self, row):
+        if self._index is not None:
+            return self._index[row]
+        return self._keys[row]
+
+    def _load(self):
+        """ Copies the mapped matrix into memory so that it can be modified """
+        if self._index is None: return
+
+        keys = list(self._index)
+        mapped = self._matrix
+        self._matrix = np.zeros((max(64, len(keys)), self._words), dtype = np.uint64)
+        self._matrix[:len(keys)] = mapped
+        del mapped
+
+        self._keys = keys
+        self._rows = {key: row for row, key in enumerate(keys)}
+        self._index.close()
+        self._index = None
+
+    def add(self, key):
+        key = _hash_to_int(key)
+        assert key.bit_length() <= self.hash_length
+        self._load()
+        if key in self._rows:
+            raise KeyError("Key already exists")
+
+        row = len(self._keys)
+        if row == len(self._matrix):
+            matrix = np.zeros((len(self._matrix) * 2, self._words), dtype = np.uint64)
+            matrix[:row] = self._matrix
+            self._matrix = matrix
+
+        self._matrix[row] = self._to_row(key)
+        self._rows[key] = row
+        self._keys.append(key)
+
+    def discard(self, key):
+        key = _hash_to_int(key)
+        self._load()
+        row = self._rows.pop(key, None)
+        if row is None: return
+
+        # Move the last row into the gap
+        last = len(self._keys) - 1
+        if row != last:
+            moved = self._keys[last]
+            self._matrix[row] = self._matrix[last]
+            self._keys[row] = moved
+            self._rows[moved] = row
+        self._keys.pop()
+
+    def __contains__(self, key):
+        if self._index is not None:
+            return key in self._index
+        return _hash_to_int(key) in self._rows
+
+    def __iter__(self):
+        if self._index is not None:
+            return iter(self._index)
+        return iter(list(self._keys))
+
+    def __len__(self):
+        if self._index is not None:
+            return len(self._index)
+        return len(self._keys)
+
+    def find_all_hamming_distance(self, key, distance, limit = None):
+        """
+        returns a set of tuples with the first entry being the distance and the second one being the hash.
+        The key itself is excluded, it doesn't need to be part of the matrix.
+        """
+
+        key = _hash_to_int(key)
+        distances = _popcount(self._matrix[:len(self)] ^ self._to_row(key))
+        return self._results(distances, distance, limit)
+
+    def find_all_hamming_distance_batch(self, keys, distance, limit = None):
+        """
+        find_all_hamming_distance for many keys at once, returns a dict with the results for every key.
+        Blocks of keys are compared with blocks of rows and run in parallel.
+        """
+
+        keys = [_hash_to_int(key) for key in keys]
+        matrix = self._matrix[:len(self)]
+
+        def search(block):
+            # Only the matches of every row block are kept, never the distances to every row
+            queries = np.stack([self._to_row(key) for key in block])
+            found = [(np.empty(0, dtype = np.intp), np.empty(0, dtype = np.int32)) for _ in block]
+            for start in range(0, len(matrix), _ROW_BLOCK):
+                distances = _popcount(matrix[start:start + _ROW_BLOCK][None, :, :] ^ queries[:, None, :])
+                for i, d in enumerate(distances):
+                    hits = np.flatnonzero((d > 0) & (d <= distance))
+                    if len(hits) == 0: continue
+                    rows, dists = found[i]
+                    found[i] = _closest(np.concatenate((rows, hits + start)), np.concatenate((dists, d[hits])), limit)
+            return [(key, self._to_results(rows, dists, limit)) for key, (rows, dists) in zip(block, found)]
+
+        blocks = [keys[start:start + _KEY_BLOCK] for start in range(0, len(keys), _KEY_BLOCK)]
+        if len(blocks) > 1:
+            with ThreadPoolExecutor(os.cpu_count()) as executor:
+                results = executor.map(search, blocks)
+        else:
+            results = map(search, blocks)
+
+        return dict(result for block in results for result in block)
+
+    def _results(self, distances, distance, limit):
+        found = np.flatnonzero((distances > 0) & (distances <= distance))
+        return self._to_results(*_closest(found, distances[found], limit), limit)
+
+    def _to_results(self, rows, distances, limit):
+        results = [(int(d), self._to_key(row)) for row, d in zip(rows, distances)]
+        if limit is not None:
+            results = sorted(results)[:limit]
+        return set(results)
+
+    def serialize_to_bitstream(self, io):
+        _write_bitstream(_serialize_keys(sorted(self), self.hash_length), io, self.hash_length)
+
+    @staticmethod
+    def deserialize_from_bitstream(io, hash_length, progress = None):
+        matrix = HashMatrix(hash_length)
+        for key in _deserialize_keys(io, hash_length, progress):
+            matrix.add(key)
+        return matrix
+
+    @staticmethod
+    def read_from_file(file, hash_size, compressed = True, progress = None):
+        """ progress gets called with the number of bytes read and the size of the file """
+        progress = _file_progress(file, progress)
+        if compressed:
+            with LZMAFile(file, "rb") as lfile:
+                matrix = HashMatrix.deserialize_from_bitstream(lfile, hash_size, progress)
+        else:
+            matrix = HashMatrix.deserialize_from_bitstream(file, hash_size, progress)
+
+        return matrix
+
+    def write_to_file(self, file, compressed = True):
+        if compressed:
+            with LZMAFile(file, "wb") as lfile:
+                self.serialize_to_bitstream(lfile)
+        else:
+            self.serialize_to_bitstream(file)
+
+    @staticmethod
+    def read_from_index(file, hash_size):
+        matrix = HashMatrix(hash_size)
+        index = HashIndexFile(file, hash_size)
+        matrix._matrix = np.frombuffer(index.buffer, dtype = np.uint64, count = len(index) * matrix._words, offset = index.offset)
+        matrix._matrix = matrix._matrix.reshape(len(index), matrix._words)
+        matrix._index = index
+        return matrix
+
+    def write_to_index(self, file):
+        if self._index is not None and self._index.file.resolve() == Path(file).resolve():
+            return # Still the same as the file
+        write_index(file, sorted(self), self.hash_length)
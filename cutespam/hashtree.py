@@ -1,11 +1,13 @@
-import struct
-
 from collections.abc import MutableSet
 from PIL import Image
 from enum import IntEnum
 from dataclasses import dataclass
 from math import ceil
 from lzma import LZMAFile
+from array import array
+from bisect import bisect_left
+
+from cutespam.hashindex import HashIndexFile, write_index
 
 class NodeValue(IntEnum):
     ROOT_NODE = 2
@@ -48,6 +50,106 @@ def _hash_to_int(key):
     assert isinstance(key, int)
     return key
 
+def _popcount(n):
+    return bin(n).count("1")
+
+_CHUNK_SIZE = 1 << 20
+_NODE_VALUES = {int(v): v for v in NodeValue}
+
+def _write_bitstream(data_it, io, hash_length):
+    hashlenb = ceil(hash_length / 8)
+    buffer = bytearray()
+    for data in data_it:
+        if data is None:
+            buffer.append(NodeValue.NONE)
+        elif isinstance(data, NodeValue):
+            buffer.append(data)
+        else:
+            buffer.append(NodeValue.VALUE)
+            buffer += data.to_bytes(hashlenb, byteorder = "big")
+
+        if len(buffer) >= _CHUNK_SIZE:
+            io.write(buffer)
+            buffer.clear()
+    io.write(buffer)
+
+def _serialize_keys(keys, hash_length):
+    """ Generates the HashTree layout from a sorted list of keys without building the tree """
+
+    def bit(key, position):
+        return (key >> (hash_length - 1 - position)) & 1
+
+    stack = [(0, 0, len(keys))] # (depth, first key, last key), None for missing nodes
+    while stack:
+        item = stack.pop()
+        if item is None:
+            yield None
+            continue
+
+        depth, lo, hi = item
+        if depth == 0:
+            yield NodeValue.ROOT_NODE
+        else:
+            yield NodeValue(bit(keys[lo], depth - 1))
+
+        if depth == hash_length:
+            yield keys[lo]
+            yield None  # children of the value node
+            yield None
+            yield None  # no right branch for a leaf
+            continue
+
+        # keys are sorted, find the first one that has a 1 at this position
+        shift = hash_length - depth - 1
+        split = bisect_left(keys, (((keys[lo] >> (shift + 1)) << 1) | 1) << shift, lo, hi) if hi > lo else lo
+        stack.append((depth + 1, split, hi) if split < hi else None)
+        stack.append((depth + 1, lo, split) if split > lo else None)
+
+def _deserialize_keys(io, hash_length, progress = None):
+    """ Only yields the keys stored in a HashTree bitstream """
+    for data in _read_bitstream(io, hash_length, progress):
+        if data is None or isinstance(data, NodeValue): continue
+        yield data
+
+def _read_bitstream(io, hash_length, progress = None):
+    """ progress gets called without arguments after every chunk that was read """
+    hashlenb = ceil(hash_length / 8)
+    chunk = bytearray(_CHUNK_SIZE)
+    data = b""
+    while True:
+        n = io.readinto(chunk)
+        if not n:
+            if data: raise ValueError("Unexpected end of file")
+            break
+        data = data + chunk[:n] if data else chunk[:n]
+
+        i = 0
+        end = len(data)
+        while i < end:
+            byte = data[i]
+            if byte == NodeValue.VALUE:
+                if i + 1 + hashlenb > end: break # Continues in the next chunk
+                yield int.from_bytes(data[i + 1:i + 1 + hashlenb], byteorder = "big")
+                i += 1 + hashlenb
+            elif byte == NodeValue.NONE:
+                yield None
+                i += 1
+            else:
+                yield _NODE_VALUES[byte]
+                i += 1
+        data = data[i:]
+
+        if progress: progress()
+
+def _file_progress(file, progress):
+    """ Calls progress with the position and the size of the file """
+    if progress is None: return None
+
+    start = file.tell()
+    total = file.seek(0, 2)
+    file.seek(start)
+    return lambda: progress(file.tell(), total)
+
 class HashTree(MutableSet):
     def __init__(self, hash_length):
         """ hash_length in bits """
@@ -75,52 +177,33 @@ class HashTree(MutableSet):
         node.left = Node(key) # Store the key as degenerate node in left
         self._len += 1
 
-    @staticmethod
-    def _serialize_node(node):
-        if node:
-            yield node.value
-            yield from HashTree._serialize_node(node.left)
-            yield from HashTree._serialize_node(node.right)
-        else: yield None
-
     def _serialize(self):
-        yield from HashTree._serialize_node(self.root)
+        """ Pre-order walk of the tree, None for missing nodes """
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node:
+                yield node.value
+                stack.append(node.right)
+                stack.append(node.left)
+            else: yield None
 
     def serialize_to_bitstream(self, io):
-        for data in self._serialize():
-            if data is None:
-                io.write(struct.pack('B', NodeValue.NONE))
-            elif isinstance(data, NodeValue):
-                io.write(struct.pack('B', data))
-            else:
-                io.write(struct.pack('B', NodeValue.VALUE))
-                io.write(data.to_bytes(ceil(self.hash_length / 8), byteorder = "big"))
+        _write_bitstream(self._serialize(), io, self.hash_length)
 
     @staticmethod
-    def deserialize_from_bitstream(io, hash_length):
-        def file_iterator():
-            hashlenb = ceil(hash_length / 8)
-            while True:
-                byte = io.read(1)
-                if not byte: break
-
-                nodev = NodeValue(struct.unpack("B", byte)[0])
-                if nodev is NodeValue.VALUE:
-                    yield int.from_bytes(io.read(hashlenb), byteorder = "big")
-                elif nodev is NodeValue.NONE:
-                    yield None
-                else:
-                    yield nodev
-            
-        return HashTree._deserialize(file_iterator(), hash_length)
+    def deserialize_from_bitstream(io, hash_length, progress = None):
+        return HashTree._deserialize(_read_bitstream(io, hash_length, progress), hash_length)
 
     @staticmethod
-    def read_from_file(file, hash_size, compressed = True):
+    def read_from_file(file, hash_size, compressed = True, progress = None):
+        """ progress gets called with the number of bytes read and the size of the file """
+        progress = _file_progress(file, progress)
         if compressed:
             with LZMAFile(file, "rb") as lfile:
-                tree = HashTree.deserialize_from_bitstream(lfile, hash_size)
+                tree = HashTree.deserialize_from_bitstream(lfile, hash_size, progress)
         else:
-            tree = HashTree.deserialize_from_bitstream(lfile, hash_size)
+            tree = HashTree.deserialize_from_bitstream(file, hash_size, progress)
 
         return tree
 
@@ -130,18 +213,7 @@ class HashTree(MutableSet):
             with LZMAFile(file, "wb") as lfile:
                 self.serialize_to_bitstream(lfile)
         else:
-            self.serialize_to_bitstream(lfile)
-
-    @staticmethod
-    def _deserialize_node(tree, it):
-        v = next(it)
-        if v is None: return None
-
-        tree._len += 1
-        node = Node(v)
-        node.left = HashTree._deserialize_node(tree, it)
-        node.right = HashTree._deserialize_node(tree, it)
-        return node
+            self.serialize_to_bitstream(file)
 
     def _to_bits(self, key):
         bits = format(key, f'0{self.hash_length}b')
@@ -153,8 +225,24 @@ class HashTree(MutableSet):
         root = Node(next(it))
         tree = HashTree(hash_length)
 
-        root.left = HashTree._deserialize_node(tree, it)
-        root.right = HashTree._deserialize_node(tree, it)
+        # Nodes that still need children, with the index of the next child
+        stack = [[root, 0]]
+        while stack:
+            item = stack[-1]
+            node, child = item
+            if child == 2:
+                stack.pop()
+                continue
+            item[1] += 1
+
+            v = next(it)
+            if v is None: continue
+
+            new_node = Node(v)
+            node[child] = new_node
+            if not isinstance(v, NodeValue): tree._len += 1 # value node
+            stack.append([new_node, 0])
+
         tree.root = root
         return tree
 
@@ -230,22 +318,24 @@ class SeedValue:
 # Algorithm found by me, no credit needed! I'm not sure if its described anywhere else
 # but for the sake of completeness I'll write my thoughts on it down here
 def find_all_hamming_distance(tree, key, distance, limit):
-    """ returns a list of tuples with the first entry being the distance and the second one being the hash """
+    """ 
+    returns a list of tuples with the first entry being the distance and the second one being the hash.
+    The tree isn't modified and the key doesn't need to be part of it.
+    """
 
     key = _hash_to_int(key)
     bits = tree._to_bits(key)
     hash_length = tree.hash_length
 
-    # find path to key
+    # find path to key, or as far as it exists. If the key isn't part of the tree
+    # this is a seed that got stuck which the first iteration branches out like any other
     node = tree.root
     key_path = [node]
     for bit in bits:
         v = node[bit]
-        if v: 
-            key_path.append(v)
-            node = v
-        else: raise KeyError("Key not found")
-    key_path = list(key_path)
+        if not v: break
+        key_path.append(v)
+        node = v
 
     seeds = [SeedValue(key_path, 1)] # We need a seed to start from
     results = set()
@@ -272,19 +362,19 @@ def find_all_hamming_distance(tree, key, distance, limit):
             if len(seed.path) <= hash_length:
                 n = len(seed.path)
                 # branch out last node
-                branch = seed.path[-1][~key_path[n].value & 1]
+                branch = seed.path[-1][~bits[n - 1] & 1]
                 if branch:
                     k_seeds.append(SeedValue(list(seed.path) + [branch], n))
                 
 
             # print(" Branched seeds:", k_seeds)
 
-            # grow the seeds by trying to take the same path as key_path from that position
+            # grow the seeds by trying to take the same path as the key from that position
             for new_seed in k_seeds:
                 
                 # print("  Before:", new_seed)
                 for n in range(len(new_seed.path) - 1, hash_length):
-                    value = key_path[n + 1].value
+                    value = bits[n]
                     node = new_seed.path[n][value]
                     if node: 
                         new_seed.path.append(node)
@@ -293,7 +383,8 @@ def find_all_hamming_distance(tree, key, distance, limit):
                 # print("  After:", new_seed)
 
                 if len(new_seed.path) - 1 == hash_length: # found a result
-                    results.add((current_distance, new_seed.path[-1].key))
+                    # the bit flip happened in this iteration, so the distance is one more than current_distance
+                    results.add((current_distance + 1, new_seed.path[-1].key))
 
                     # if we reached the limit there's no point in continuing, just return the results now
                     if limit is not None and len(results) >= limit: return results
@@ -304,4 +395,224 @@ def find_all_hamming_distance(tree, key, distance, limit):
                     
         seeds = n_seeds # set seeds for next iteration
 
-    return results
\ No newline at end of file
+    return results
+
+class CompactHashTree(MutableSet):
+    """
+    Same interface as HashTree but stored as a crit-bit tree in flat arrays.
+    Every inner node tests a single bit position and skips over the bits its children share,
+    which means there are exactly len(tree) - 1 inner nodes instead of one node per bit.
+    Leaves are referenced with negative indices (~index into _keys).
+    """
+
+    def __init__(self, hash_length):
+        """ hash_length in bits """
+        self.hash_length = hash_length
+        self._len = 0
+
+        self._root = None
+        self._crit = array("H")                     # bit position (counted from the msb) that is tested
+        self._children = (array("q"), array("q"))   # child for a 0 or 1 at the tested position
+        self._rep = array("q")                      # any leaf below the node, has the same prefix as the node
+        self._keys = []
+
+        self._free_nodes = []
+        self._free_keys = []
+
+    def _bit(self, key, position):
+        return (key >> (self.hash_length - 1 - position)) & 1
+
+    def _new_node(self, crit, rep):
+        if self._free_nodes:
+            node = self._free_nodes.pop()
+            self._crit[node] = crit
+            self._rep[node] = rep
+        else:
+            node = len(self._crit)
+            self._crit.append(crit)
+            self._rep.append(rep)
+            self._children[0].append(0)
+            self._children[1].append(0)
+        return node
+
+    def _new_leaf(self, key):
+        if self._free_keys:
+            leaf = self._free_keys.pop()
+            self._keys[leaf] = key
+        else:
+            leaf = len(self._keys)
+            self._keys.append(key)
+        return leaf
+
+    def _find_leaf(self, key):
+        """ Returns the leaf that shares the most bits with the key, this doesn't need to be the key itself """
+        node = self._root
+        while node >= 0:
+            node = self._children[self._bit(key, self._crit[node])][node]
+        return ~node
+
+    def add(self, key):
+        key = _hash_to_int(key)
+        assert key.bit_length() <= self.hash_length
+
+        if self._root is None:
+            self._root = ~self._new_leaf(key)
+            self._len += 1
+            return
+
+        other = self._keys[self._find_leaf(key)]
+        if other == key:
+            raise KeyError("Key already exists")
+
+        crit = self.hash_length - (key ^ other).bit_length() # first bit that differs
+        parent = None
+        direction = 0
+        node = self._root
+        while node >= 0 and self._crit[node] < crit:
+            parent = node
+            direction = self._bit(key, self._crit[node])
+            node = self._children[direction][node]
+
+        leaf = self._new_leaf(key)
+        new_node = self._new_node(crit, leaf)
+        bit = self._bit(key, crit)
+        self._children[bit][new_node] = ~leaf
+        self._children[bit ^ 1][new_node] = node
+
+        if parent is None: self._root = new_node
+        else: self._children[direction][parent] = new_node
+        self._len += 1
+
+    def discard(self, key):
+        key = _hash_to_int(key)
+        if self._root is None: return
+
+        path = []
+        node = self._root
+        while node >= 0:
+            direction = self._bit(key, self._crit[node])
+            path.append((node, direction))
+            node = self._children[direction][node]
+
+        leaf = ~node
+        if self._keys[leaf] != key: return
+
+        if path:
+            # The parent gets replaced by the other branch
+            parent, direction = path.pop()
+            sibling = self._children[direction ^ 1][parent]
+            if path:
+                grandparent, gdirection = path[-1]
+                self._children[gdirection][grandparent] = sibling
+            else: self._root = sibling
+            self._free_nodes.append(parent)
+
+            # Nodes further up might still use the removed leaf for their prefix
+            rep = ~sibling if sibling < 0 else self._rep[sibling]
+            for node, _ in path:
+                if self._rep[node] == leaf: self._rep[node] = rep
+        else:
+            self._root = None
+
+        self._keys[leaf] = None
+        self._free_keys.append(leaf)
+        self._len -= 1
+
+    def __contains__(self, key):
+        key = _hash_to_int(key)
+        if self._root is None: return False
+        return self._keys[self._find_leaf(key)] == key
+
+    def __iter__(self):
+        if self._root is None: return
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node < 0:
+                yield self._keys[~node]
+            else:
+                stack.append(self._children[1][node])
+                stack.append(self._children[0][node])
+
+    def __len__(self):
+        return self._len
+
+    def find_all_hamming_distance(self, key, distance, limit = None):
+        """ 
+        returns a set of tuples with the first entry being the distance and the second one being the hash.
+        The key itself is excluded, it doesn't need to be part of the tree.
+        """
+
+        key = _hash_to_int(key)
+        results = []
+        if self._root is None: return set()
+
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node < 0:
+                other = self._keys[~node]
+                d = _popcount(other ^ key)
+                if 0 < d <= distance:
+                    results.append((d, other))
+                continue
+
+            # All keys below the node share the bits up to the tested position
+            shift = self.hash_length - self._crit[node]
+            if _popcount((self._keys[self._rep[node]] ^ key) >> shift) > distance: continue
+
+            stack.append(self._children[1][node])
+            stack.append(self._children[0][node])
+
+        if limit is not None:
+            results = sorted(results)[:limit]
+        return set(results)
+
+    def find_all_hamming_distance_batch(self, keys, distance, limit = None):
+        """ find_all_hamming_distance for many keys at once, returns a dict with the results for every key """
+        return {key: self.find_all_hamming_distance(key, distance, limit) for key in map(_hash_to_int, keys)}
+
+    def _serialize(self):
+        """ Yields the same data as HashTree._serialize, one entry per bit of every key """
+        yield from _serialize_keys(list(self), self.hash_length)
+
+    def serialize_to_bitstream(self, io):
+        _write_bitstream(self._serialize(), io, self.hash_length)
+
+    @staticmethod
+    def deserialize_from_bitstream(io, hash_length, progress = None):
+        tree = CompactHashTree(hash_length)
+        for key in _deserialize_keys(io, hash_length, progress):
+            tree.add(key)
+        return tree
+
+    @staticmethod
+    def read_from_file(file, hash_size, compressed = True, progress = None):
+        """ progress gets called with the number of bytes read and the size of the file """
+        progress = _file_progress(file, progress)
+        if compressed:
+            with LZMAFile(file, "rb") as lfile:
+                tree = CompactHashTree.deserialize_from_bitstream(lfile, hash_size, progress)
+        else:
+            tree = CompactHashTree.deserialize_from_bitstream(file, hash_size, progress)
+
+        return tree
+
+    def write_to_file(self, file, compressed = True):
+        if compressed:
+            with LZMAFile(file, "wb") as lfile:
+                self.serialize_to_bitstream(lfile)
+        else:
+            self.serialize_to_bitstream(file)
+
+    @staticmethod
+    def read_from_index(file, hash_size):
+        tree = CompactHashTree(hash_size)
+        index = HashIndexFile(file, hash_size)
+        try:
+            for key in index: tree.add(key)
+        finally: index.close()
+        return tree
+
+    def write_to_index(self, file):
+        write_index(file, list(self), self.hash_length) # already sorted
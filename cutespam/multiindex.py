@@ -0,0 +1,243 @@
+import multiprocessing, os
+
+from collections.abc import MutableSet
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations
+from lzma import LZMAFile
+
+from cutespam.hashtree import _hash_to_int, _popcount, _write_bitstream, _serialize_keys, _deserialize_keys, _file_progress
+from cutespam.hashindex import HashIndexFile, write_index
+
+def _binomial(n, k):
+    result = 1
+    for i in range(k):
+        result = result * (n - i) // (i + 1)
+    return result
+
+# Number of keys that get sent to a worker at once
+_KEYS_PER_TASK = 1 << 14
+
+def _substrings(hash_length, count):
+    """ (shift, length) of count substrings that cover hash_length bits, the last one takes the remaining bits """
+    substring_length = hash_length // count
+    substrings = []
+    for n in range(count):
+        length = substring_length if n < count - 1 else hash_length - substring_length * (count - 1)
+        substrings.append((hash_length - substring_length * n - length, length))
+    return substrings
+
+def _split(key, substrings):
+    for shift, length in substrings:
+        yield (key >> shift) & ((1 << length) - 1)
+
+# State of the pair search, built once before the workers fork or in every worker process without fork
+_pairs_keys = None
+_pairs_substrings = None
+_pairs_tables = {}
+
+def _init_pairs(keys, substrings):
+    global _pairs_keys, _pairs_substrings, _pairs_tables
+    _pairs_keys = keys
+    _pairs_substrings = substrings
+    _pairs_tables = {}
+
+def _pairs_table(n):
+    table = _pairs_tables.get(n)
+    if table is None:
+        shift, length = _pairs_substrings[n]
+        mask = (1 << length) - 1
+        table = _pairs_tables[n] = {}
+        for key in _pairs_keys:
+            bucket = table.get((key >> shift) & mask)
+            if bucket is None: table[(key >> shift) & mask] = [key]
+            else: bucket.append(key)
+    return table
+
+def _pairs_for_keys(n, start, end, distance):
+    """
+    Finds the pairs for the keys in _pairs_keys[start:end] using the nth substring.
+    A pair is only reported by the first substring that is close enough
+    and by its smaller key, so that every pair is found once.
+    """
+
+    table = _pairs_table(n)
+    shift, length = _pairs_substrings[n]
+    mask = (1 << length) - 1
+    radius = distance // len(_pairs_substrings)
+    earlier = _pairs_substrings[:n]
+    flips = [sum(1 << bit for bit in bits) for r in range(radius + 1) for bits in combinations(range(length), r)]
+
+    pairs = []
+    for a in _pairs_keys[start:end]:
+        substring = (a >> shift) & mask
+        for flip in flips:
+            for b in table.get(substring ^ flip, ()):
+                if b <= a: continue
+                x = a ^ b
+                d = _popcount(x)
+                if d > distance: continue
+                if any(_popcount((x >> s) & ((1 << l) - 1)) <= radius for s, l in earlier): continue
+                pairs.append((d, a, b))
+    return pairs
+
+def find_all_pairs(keys, hash_length, distance, workers = None):
+    """
+    Finds all pairs of keys that are within distance of each other, returns a list of (distance, a, b) tuples with a < b.
+    Uses multi-index hashing with substrings of about log2(len(keys)) bits so that
+    every bucket holds few keys. The keys are searched in chunks with a process pool of workers, None uses all cpus.
+    The substring tables are built once and shared with the workers where processes can fork.
+    """
+
+    keys = sorted(set(map(_hash_to_int, keys)))
+    if len(keys) < 2: return []
+
+    bits = max(1, (len(keys) - 1).bit_length())
+    substrings = _substrings(hash_length, max(1, min(distance + 1, hash_length // bits)))
+    tasks = [(n, start, start + _KEYS_PER_TASK, distance)
+        for n in range(len(substrings)) for start in range(0, len(keys), _KEYS_PER_TASK)]
+
+    if workers is None: workers = os.cpu_count()
+    _init_pairs(keys, substrings)
+    try:
+        if workers > 1 and len(tasks) > 1:
+            if "fork" in multiprocessing.get_all_start_methods():
+                # The workers inherit the tables copy-on-write instead of building their own
+                for n in range(len(substrings)): _pairs_table(n)
+                pool = ProcessPoolExecutor(workers, mp_context = multiprocessing.get_context("fork"))
+            else:
+                pool = ProcessPoolExecutor(workers, initializer = _init_pairs, initargs = (keys, substrings))
+            with pool as executor:
+                futures = [executor.submit(_pairs_for_keys, *task) for task in tasks]
+                return [pair for future in futures for pair in future.result()]
+
+        return [pair for task in tasks for pair in _pairs_for_keys(*task)]
+    finally:
+        _init_pairs(None, None)
+
+class MultiIndexHash(MutableSet):
+    """
+    Multi-index hashing as described by Norouzi et al., "Fast Search in Hamming Space with Multi-Index Hashing".
+    Every hash is split into substrings and each substring gets its own hash table.
+    If two hashes are within a distance r then at least one of their substrings is within r // m,
+    so a search only needs to probe the buckets close to the substrings of the key.
+    """
+
+    def __init__(self, hash_length, substring_length = 16):
+        """ hash_length in bits """
+        self.hash_length = hash_length
+        self._keys = set()
+
+        self._substrings = _substrings(hash_length, max(1, hash_length // substring_length))
+        self._tables = [{} for _ in self._substrings]
+
+    def _split(self, key):
+        return _split(key, self._substrings)
+
+    def add(self, key):
+        key = _hash_to_int(key)
+        assert key.bit_length() <= self.hash_length
+        if key in self._keys:
+            raise KeyError("Key already exists")
+
+        self._keys.add(key)
+        for table, substring in zip(self._tables, self._split(key)):
+            bucket = table.get(substring)
+            if bucket is None: table[substring] = [key]
+            else: bucket.append(key)
+
+    def discard(self, key):
+        key = _hash_to_int(key)
+        if key not in self._keys: return
+
+        self._keys.remove(key)
+        for table, substring in zip(self._tables, self._split(key)):
+            bucket = table[substring]
+            bucket.remove(key)
+            if not bucket: del table[substring]
+
+    def __contains__(self, key):
+        return _hash_to_int(key) in self._keys
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _candidates(self, key, distance):
+        radius = distance // len(self._substrings)
+        probes = sum(_binomial(length, r) for _, length in self._substrings for r in range(radius + 1))
+        if probes >= len(self._keys):
+            # Probing would touch more buckets than there are keys, just compare with all of them
+            yield from self._keys
+            return
+
+        for table, substring, (_, length) in zip(self._tables, self._split(key), self._substrings):
+            for r in range(radius + 1):
+                for bits in combinations(range(length), r):
+                    flipped = substring
+                    for bit in bits: flipped ^= 1 << bit
+                    bucket = table.get(flipped)
+                    if bucket: yield from bucket
+
+    def find_all_hamming_distance(self, key, distance, limit = None):
+        """
+        returns a set of tuples with the first entry being the distance and the second one being the hash.
+        The key itself is excluded, it doesn't need to be part of the index.
+        """
+
+        key = _hash_to_int(key)
+        results = set()
+        for other in self._candidates(key, distance):
+            d = _popcount(other ^ key)
+            if 0 < d <= distance:
+                results.add((d, other))
+
+        if limit is not None:
+            results = set(sorted(results)[:limit])
+        return results
+
+    def find_all_hamming_distance_batch(self, keys, distance, limit = None):
+        """ find_all_hamming_distance for many keys at once, returns a dict with the results for every key """
+        return {key: self.find_all_hamming_distance(key, distance, limit) for key in map(_hash_to_int, keys)}
+
+    def serialize_to_bitstream(self, io):
+        _write_bitstream(_serialize_keys(sorted(self._keys), self.hash_length), io, self.hash_length)
+
+    @staticmethod
+    def deserialize_from_bitstream(io, hash_length, progress = None):
+        index = MultiIndexHash(hash_length)
+        for key in _deserialize_keys(io, hash_length, progress):
+            index.add(key)
+        return index
+
+    @staticmethod
+    def read_from_file(file, hash_size, compressed = True, progress = None):
+        """ progress gets called with the number of bytes read and the size of the file """
+        progress = _file_progress(file, progress)
+        if compressed:
+            with LZMAFile(file, "rb") as lfile:
+                index = MultiIndexHash.deserialize_from_bitstream(lfile, hash_size, progress)
+        else:
+            index = MultiIndexHash.deserialize_from_bitstream(file, hash_size, progress)
+
+        return index
+
+    def write_to_file(self, file, compressed = True):
+        if compressed:
+            with LZMAFile(file, "wb") as lfile:
+                self.serialize_to_bitstream(lfile)
+        else:
+            self.serialize_to_bitstream(file)
+
+    @staticmethod
+    def read_from_index(file, hash_size):
+        index = MultiIndexHash(hash_size)
+        keys = HashIndexFile(file, hash_size)
+        try:
+            for key in keys: index.add(key)
+        finally: keys.close()
+        return index
+
+    def write_to_index(self, file):
+        write_index(file, sorted(self._keys), self.hash_length)
@@ -1,4 +1,4 @@
-import json, typing
+import json, typing, re, os, stat, threading
 
 from lxml import etree as ET
 from uuid import uuid4, UUID
@@ -11,6 +11,19 @@ from copy import deepcopy
 from cutespam import JSONEncoder, BASE_PATH
 
 RDF_NS = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+RDF_DESCRIPTION = "{%s}Description" % RDF_NS
+
+# Characters that can't be in an xml file
+_INVALID_XML = re.compile("[^\t\n\r\x20-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]")
+
+def _escape(value: str, attribute = False) -> str:
+    """ Escapes like lxml does, non ascii characters are escaped when the whole file gets encoded """
+    if _INVALID_XML.search(value):
+        raise ValueError("All strings must be XML compatible: Unicode or ASCII, no NULL bytes or control characters")
+    value = value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace("\r", "&#13;")
+    if attribute:
+        value = value.replace('"', "&quot;").replace("\n", "&#10;").replace("\t", "&#9;")
+    return value
 
 class Tag:
     def __init__(self, tag_name: str, tag_type: str, name:str, tpe: type):
@@ -19,6 +32,59 @@ class Tag:
         self.name = name
         self.type = tpe
 
+class _Template:
+    """
+    The xmp template as text that write fills in, gives the same output as the pretty printed tree.
+    root is the template without any tags.
+    """
+
+    def __init__(self, root):
+        root = deepcopy(root)
+        description = root.find(".//" + RDF_DESCRIPTION)
+        self.prefixes = {ns: prefix for prefix, ns in description.nsmap.items()}
+        self.names = {}
+
+        description.append(ET.Comment("properties"))
+        head, tail = ET.tostring(root, method = "xml", pretty_print = True).decode().split("<!--properties-->")
+        head, self.indent = head.rsplit("\n", 1)
+        self.head = head[:-len(">")] # attributes go after this
+        self.tail = tail
+        self.empty_tail = "/>" + tail[tail.index(">") + 1:] # description without children
+
+    def name(self, tag_name):
+        """ prefix:name of a {namespace}name """
+        name = self.names.get(tag_name)
+        if name is None:
+            ns, local = tag_name[1:].split("}")
+            name = self.names[tag_name] = f"{self.prefixes[ns]}:{local}"
+        return name
+
+    def fill(self, attributes, properties) -> str:
+        """
+        attributes is a list of (tag name, value) for the description,
+        properties a list of (tag name, container tag name, values, language).
+        Returns the file with non ascii characters escaped
+        """
+        xml = [self.head]
+        for tag_name, value in attributes:
+            xml.append(f' {self.name(tag_name)}="{_escape(value, attribute = True)}"')
+
+        if not properties:
+            xml.append(self.empty_tail)
+        else:
+            xml.append(">")
+            li = self.name("{%s}li" % RDF_NS)
+            for tag_name, tag_type, values, lang in properties:
+                xml.append(f"\n{self.indent}<{self.name(tag_name)}>\n{self.indent}  <{self.name(tag_type)}>")
+                for value in values:
+                    start = f'{li} xml:lang="{lang}"' if lang else li
+                    if value is None: xml.append(f"\n{self.indent}    <{start}/>")
+                    else: xml.append(f"\n{self.indent}    <{start}>{_escape(value)}</{li}>")
+                xml.append(f"\n{self.indent}  </{self.name(tag_type)}>\n{self.indent}</{self.name(tag_name)}>")
+            xml.append(self.tail)
+
+        return "".join(xml).encode("ascii", "xmlcharrefreplace").decode()
+
 class _Meta(type):
     def __init__(cls: "Meta", name, bases, nmspc):
         if cls._XMP:
@@ -45,9 +111,15 @@ class _Meta(type):
 
                     setattr(cls, k, Tag(tag_name, tag_type, k, tpe))
 
+            # Tag for every element or attribute name, used by read
+            cls._TAGS = {tag.tag_name: tag for tag in vars(cls).values() if isinstance(tag, Tag)}
+            cls._TEMPLATE = _Template(root)
+
 class Meta(metaclass = _Meta):
     _XMP = None
     _XMP_ETREE: ET.Element = None
+    _TAGS = {}
+    _TEMPLATE: _Template = None
 
     def __init__(self, filename = None):
         self._filename = filename
@@ -104,14 +176,26 @@ class Meta(metaclass = _Meta):
 
         with open(self.filename, "r") as file:
             self._XMP_ETREE = root = ET.fromstring(file.read())
+
+        # One walk over the tree collects the first element of every tag and
+        # the first rdf:Description that has every attribute, same as root.find(".//...")
+        tags = type(self)._TAGS
+        elements = {}
+        attributes = {}
+        for elem in root.iterdescendants(RDF_DESCRIPTION, *tags):
+            if elem.tag == RDF_DESCRIPTION:
+                for name, value in elem.attrib.items():
+                    if name in tags: attributes.setdefault(name, value)
+            else:
+                elements.setdefault(elem.tag, elem)
             
         for k in self.tag_names():
             value = None
             tag = getattr(type(self), k)
+            elem = elements.get(tag.tag_name)
 
             if tag.tag_type:
                 # complex value
-                elem = root.find(f".//{tag.tag_name}")
                 if elem is not None:
                     if tag.tag_type == "{%s}Alt" % RDF_NS:
                         value = elem[0][0].text
@@ -121,12 +205,10 @@ class Meta(metaclass = _Meta):
                         #if len(value) == 1 and not list(value)[0]: value = None
             else:
                 # simple value
-                description = root.find(".//{%s}Description[@%s]" % (RDF_NS, tag.tag_name))
-                if description is not None:
-                    value = deserialize(description.attrib[tag.tag_name], tag.type)
+                if tag.tag_name in attributes:
+                    value = deserialize(attributes[tag.tag_name], tag.type)
                 # maybe wrong format?
-                elem = root.find(f".//{tag.tag_name}")
-                if elem:
+                if elem is not None and len(elem):
                     value = deserialize(elem.text, tag.type)
             
             setattr(self, k, value)
@@ -140,44 +222,40 @@ class Meta(metaclass = _Meta):
                 return value.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
             return str(value)
 
-        if self._XMP_ETREE is not None:
-            self._XMP_ETREE = deepcopy(type(self)._XMP_ETREE)
-
-        root = self._XMP_ETREE
+        attributes = []
+        properties = []
         for k, value in self.properties():
             tag = getattr(type(self), k)
-            elem = root.find(f".//{tag.tag_name}")
-            description = root.find(".//{%s}Description" % RDF_NS)
-            
-            if elem:
-                # delete existing value
-                elem.getparent().remove(elem)
 
             if value is None: continue
             if tag.tag_type:
                 # complex value
                 if not value: continue # empty list/set
-                propety = ET.Element(tag.tag_name)
-                elem = ET.Element(tag.tag_type)
                 if tag.tag_type == "{%s}Alt" % RDF_NS:
-                    v = ET.Element("{%s}li" % RDF_NS)
-                    v.attrib["{http://www.w3.org/XML/1998/namespace}lang"] = "x-default"
-                    v.text = serialize(value, tag.type)
-                    elem.append(v)
+                    properties.append((tag.tag_name, tag.tag_type, [serialize(value, tag.type)], "x-default"))
                 else:
-                    for e in value:
-                        v = ET.Element("{%s}li" % RDF_NS)
-                        v.text = e
-                        elem.append(v)
-
-                propety.append(elem)
-                description.append(propety)
-                
+                    properties.append((tag.tag_name, tag.tag_type, value, None))
             else: # simple value
-                description.attrib[tag.tag_name] = serialize(value, tag.type)
-                    
-        with open(self.filename, "w") as file:
-            file.write(ET.tostring(self._XMP_ETREE, method = "xml", pretty_print = True).decode())
+                attributes.append((tag.tag_name, serialize(value, tag.type)))
+
+        xml = type(self)._TEMPLATE.fill(attributes, properties)
+
+        # Written next to the file and moved over it, so nobody reads half a file.
+        # A symlink stays in place, its target gets replaced
+        filename = Path(self.filename).resolve()
+        tmp = filename.with_name(f".{filename.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(tmp, "w") as file:
+                file.write(xml)
+                file.flush()
+                os.fsync(file.fileno())
+            if filename.exists():
+                os.chmod(tmp, stat.S_IMODE(filename.stat().st_mode))
+            os.replace(tmp, filename)
+        except:
+            try: os.remove(tmp)
+            except FileNotFoundError: pass
+            raise
 
     def clear(self):
         for k, _ in self.properties():
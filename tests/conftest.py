@@ -1,3 +1,5 @@
+import pytest
+
 def pytest_addoption(parser):
     parser.addoption("--data-folder", default = None)
 
@@ -8,4 +10,73 @@ def pytest_generate_tests(metafunc):
 
     data_folder = metafunc.config.option.data_folder
     if "data_folder" in metafunc.fixturenames:
-        metafunc.parametrize("data_folder", [data_folder])
\ No newline at end of file
+        metafunc.parametrize("data_folder", [data_folder])
+
+@pytest.fixture
+def start_database(tmp_path, monkeypatch):
+    """ Sets up the paths for a database inside of tmp_path, returns a function that (re)starts it and returns the db module """
+    from cutespam import db
+    from cutespam.config import config
+
+    monkeypatch.setattr(config, "image_folder", tmp_path / "images")
+    monkeypatch.setattr(config, "metadbf", tmp_path / "metadata.db")
+    monkeypatch.setattr(config, "hashdbf", tmp_path / "hashes.db")
+    config.image_folder.mkdir()
+
+    monkeypatch.setattr(db, "__rpccon", False) # Don't connect to a running service
+    monkeypatch.setattr(db, "__hashes", None)
+    monkeypatch.setattr(db, "__db", None)
+    # Every test starts with empty in memory state, nothing is left over from an earlier test
+    monkeypatch.setattr(db, "__keywords", db.PrefixIndex())
+    monkeypatch.setattr(db, "__uids", db.PrefixIndex())
+    monkeypatch.setattr(db, "__dirty", [db.OrderedSetQueue() for _ in range(db._WRITERS)])
+
+    exits = []
+    monkeypatch.setattr(db.atexit, "register", exits.append)
+
+    def start():
+        while exits: exits.pop()()
+        db.init_db()
+        return db
+
+    yield start
+    for exit in exits: exit()
+
+@pytest.fixture
+def database(start_database):
+    """ Sets up an empty database inside of tmp_path and returns the db module """
+    return start_database()
+
+@pytest.fixture
+def write_image(start_database):
+    """ Writes an xmp file to the image folder without loading it into the database """
+    from uuid import uuid4
+    from datetime import datetime
+    from cutespam.config import config
+    from cutespam.xmpmeta import CuteMeta
+
+    def write_image(hash, **kwargs):
+        uid = kwargs.pop("uid", None) or uuid4()
+        meta = CuteMeta(filename = config.image_folder / (str(uid) + ".xmp"))
+        meta.uid = uid
+        meta.hash = hash
+        meta.date = meta.last_updated = datetime.utcnow()
+        for k, v in kwargs.items():
+            setattr(meta, k, v)
+        meta.generate_keywords()
+        meta.write()
+        return uid
+
+    return write_image
+
+@pytest.fixture
+def add_image(database, write_image):
+    """ Writes an xmp file to the image folder and loads it into the database """
+    from cutespam.config import config
+
+    def add_image(hash, **kwargs):
+        uid = write_image(hash, **kwargs)
+        database.load_file(config.image_folder / (str(uid) + ".xmp"))
+        return uid
+
+    return add_image
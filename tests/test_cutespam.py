@@ -0,0 +1,58 @@
+import threading
+
+from cutespam import RWLock, PrefixIndex, OrderedSetQueue
+
+def test_rw_lock():
+    lock = RWLock()
+    events = []
+    reading = threading.Barrier(2, timeout = 5)
+
+    def reader():
+        with lock.read():
+            reading.wait() # Both readers need to hold the lock at the same time
+            events.append("read")
+
+    def writer():
+        with lock.write():
+            events.append("write")
+
+    readers = [threading.Thread(target = reader) for _ in range(0, 2)]
+    with lock.write():
+        for t in readers: t.start()
+        events.append("first write")
+    for t in readers: t.join()
+
+    w = threading.Thread(target = writer)
+    w.start()
+    w.join()
+
+    assert events == ["first write", "read", "read", "write"]
+
+def test_prefix_index():
+    index = PrefixIndex([("abc", 1), ("Abd", 2)])
+    index.add("b")
+    index.add("abc")
+    assert index.prefixed("ab") == ["abc", "Abd"]
+    index.discard("abc")
+    index.discard("Abd")
+    assert index.prefixed("AB") == ["abc", "Abd"]
+    index.discard("abc")
+    assert index.prefixed("") == ["Abd", "b"]
+    assert "abc" not in index and len(index) == 2
+
+def test_ordered_set_queue():
+    q = OrderedSetQueue()
+    for item in (1, 2, 1, 3, 2):
+        q.put(item)
+    assert q.qsize() == 3
+
+    items = []
+    while not q.empty():
+        items.append(q.get())
+        q.task_done()
+    assert items == [1, 2, 3]
+
+    done = threading.Thread(target = q.join)
+    done.start()
+    done.join(5)
+    assert not done.is_alive()
@@ -1,4 +1,4 @@
-import pytest
+import pytest, random
 
 from cutespam.config import config
 from cutespam.hashtree import HashTree
@@ -41,4 +41,556 @@ def test_read_database():
 
     with open(HASH_FILE, "r") as hashesf:
         for h in hashesf:
-            assert h in tree
\ No newline at end of file
+            assert h in tree
+
+def test_find_similar_images_batch(database, add_image):
+    base = random.getrandbits(256)
+    hashes = [base ^ (1 << n) for n in range(0, 10)] + [random.getrandbits(256) for _ in range(0, 10)]
+    for h in hashes:
+        add_image(format(h, "064x"))
+
+    queries = [format(h, "064x") for h in hashes[::3]] + [format(base, "064x")]
+    result = database.find_similar_images_batch(queries, 0.9, 5)
+    assert set(result) == set(queries)
+    for h in queries:
+        assert result[h] == database.find_similar_images_hash(h, 0.9, 5)
+    
+    assert len(result[format(base, "064x")]) == 5
+    assert base not in getattr(database, "__hashes")
+
+def test_find_all_near_duplicates(database, add_image):
+    base = random.getrandbits(256)
+    near = [add_image(format(base ^ (1 << n), "064x")) for n in range(0, 5)]
+    exact = [add_image(format(base >> 1, "064x")) for _ in range(0, 2)]
+    add_image(format(random.getrandbits(256), "064x"))
+
+    clusters = database.find_all_near_duplicates(0.99, workers = 1)
+    assert clusters == [set(near), set(exact)]
+
+def test_cold_start(start_database, write_image, monkeypatch):
+    import os
+    monkeypatch.setattr(os, "cpu_count", lambda: 2) # Make sure that the files get loaded in parallel
+
+    uids = set(write_image(format(random.getrandbits(256), "064x"), keywords = {"test"}) for _ in range(0, 150))
+
+    database = start_database()
+    assert set(database.get_all_uids()) == uids
+    assert len(getattr(database, "__hashes")) == len(uids)
+    assert database.get_uids_from_keyword("test") == uids
+
+def test_catch_up_modified_files(start_database, write_image, monkeypatch):
+    import os, time
+    from datetime import datetime
+
+    uids = [write_image(format(random.getrandbits(256), "064x")) for _ in range(0, 5)]
+    for uid in uids: # pretend these are old
+        xmpf = config.image_folder / (str(uid) + ".xmp")
+        os.utime(xmpf, (time.time() - 100, time.time() - 100))
+
+    database = start_database()
+    
+    meta = CuteMeta.from_file(config.image_folder / (str(uids[0]) + ".xmp"))
+    meta.caption = "modified"
+    meta.last_updated = datetime.utcnow()
+    meta.write()
+    added = write_image(format(random.getrandbits(256), "064x"))
+
+    saved = []
+    save_file = database._save_file
+    monkeypatch.setattr(database, "_save_file", lambda xmpf, db: saved.append(xmpf) or save_file(xmpf, db))
+
+    database = start_database()
+    assert [xmpf.stem for xmpf in saved] == [str(uids[0])]
+    assert database.get_meta(uids[0]).caption == "modified"
+    assert added in database.get_all_uids()
+
+def test_save_file_unchanged(database, add_image, monkeypatch):
+    uid = add_image(format(random.getrandbits(256), "064x"))
+    xmpf = config.image_folder / (str(uid) + ".xmp")
+
+    def fail(fp): raise AssertionError("%s was read again" % fp)
+    monkeypatch.setattr(CuteMeta, "from_file", fail)
+    database.save_file(xmpf)
+
+    with open(xmpf, "a") as fp: fp.write(" ")
+    with pytest.raises(AssertionError):
+        database.save_file(xmpf)
+
+def test_query(database, add_image):
+    images = {}
+    for n in range(0, 30):
+        keywords = set(random.sample(["a", "b", "c", "d"], random.randint(0, 3)))
+        author = random.choice([None, "someone", "someone else"])
+        uid = add_image(format(random.getrandbits(256), "064x"), keywords = keywords, author = author)
+        images[uid] = database.get_meta(uid)
+
+    def expected(f):
+        return sorted((uid for uid, meta in images.items() if f(meta)), key = lambda uid: uid.hex)
+
+    keywords = lambda meta: meta.keywords or set()
+    assert database.query() == expected(lambda meta: True)
+    assert database.query(keyword = ["a", "b"]) == expected(lambda meta: keywords(meta) & {"a", "b"})
+    assert database.query(not_keyword = ["a", "b"]) == expected(lambda meta: not keywords(meta) & {"a", "b"})
+    assert database.query(keyword = ["c"], not_keyword = ["d"]) == expected(lambda meta: "c" in keywords(meta) and "d" not in keywords(meta))
+    assert database.query(author = "someone%") == expected(lambda meta: meta.author)
+    assert database.query(author = "") == expected(lambda meta: not meta.author)
+    assert database.query(author = "someone", keyword = ["a"]) == expected(lambda meta: meta.author == "someone" and "a" in keywords(meta))
+
+    assert database.query(keyword = ["a"], limit = 3) == expected(lambda meta: "a" in keywords(meta))[:3]
+    assert database.query(keyword = ["a"], count = True) == len(expected(lambda meta: "a" in keywords(meta)))
+    assert database.query(limit = 5, count = True) == 5
+    assert sorted(database.query(random = True), key = lambda uid: uid.hex) == database.query()
+
+def test_migrate_database(start_database, write_image):
+    import sqlite3
+    from cutespam import db
+    from cutespam.hashtree import CompactHashTree
+
+    h = format(random.getrandbits(256), "064x")
+    uid = write_image(h, keywords = {"a", "b"})
+
+    # Schema from before the migrations
+    old = sqlite3.connect(str(config.metadbf))
+    old.executescript("""
+        CREATE TABLE Metadata (
+            uid UUID PRIMARY KEY not null,
+            last_updated timestamp not null DEFAULT(strftime('%Y-%m-%d %H:%M:%f', 'now')),
+            hash TEXT not null,
+            caption TEXT,
+            author TEXT,
+            source TEXT,
+            group_id UUID,
+            date timestamp not null DEFAULT(strftime('%Y-%m-%d %H:%M:%f', 'now')),
+            rating Rating,
+            source_other PSet,
+            source_via PSet
+        ) WITHOUT ROWID;
+        CREATE TABLE Metadata_Keywords (uid UUID not null, keyword TEXT NOT NULL);
+        CREATE TABLE Metadata_Collections (uid UUID not null, collection TEXT NOT NULL);
+    """)
+    old.execute("insert into Metadata (uid, hash, last_updated) values (?, ?, '2100-01-01 00:00:00.000')", (uid.hex, h)) # newer than the file
+    old.executemany("insert into Metadata_Keywords values (?, ?)", [(uid.hex, "a"), (uid.hex, "a"), (uid.hex, "b")])
+    old.commit()
+    old.close()
+
+    tree = CompactHashTree(config.hash_length)
+    tree.add(h)
+    tree.write_to_index(config.hashdbf)
+
+    database = start_database()
+    conn = getattr(database, "__db")
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(db._MIGRATIONS)
+    assert conn.execute("select count(*) from Metadata_Keywords where uid is ?", (uid.hex,)).fetchone()[0] == 2
+    assert conn.execute("select file_size, file_mtime from Metadata").fetchone()[0] is not None
+
+    assert database.get_meta(uid).keywords == {"a", "b"}
+    assert database.search("b") == [uid]
+    assert conn.execute("select count(*) from Keywords").fetchone()[0] == 2
+
+    plan = " ".join(r[-1] for r in conn.execute("explain query plan select uid from Metadata_Keywords where keyword_id = 1"))
+    assert "USING" in plan and "INDEX" in plan
+
+    with pytest.raises(sqlite3.IntegrityError):
+        conn.execute("insert into Metadata_Keywords select ?, id from Keywords where name = 'a'", (uid,))
+
+    # Running it again doesn't change anything
+    database = start_database()
+    assert getattr(database, "__db").execute("PRAGMA user_version").fetchone()[0] == len(db._MIGRATIONS)
+
+def test_keywords(database, add_image):
+    uids = [add_image(format(random.getrandbits(256), "064x"), keywords = {"shared", "own" + str(n)}) for n in range(0, 3)]
+    assert database.get_uids_from_keyword("shared") == set(uids)
+    assert database.get_tab_complete_keywords("own") == {"own0", "own1", "own2"}
+
+    database.remove_image(uids[0])
+    assert database.get_tab_complete_keywords("own") == {"own1", "own2"}
+
+    conn = getattr(database, "__db")
+    assert conn.execute("select count(*) from Keywords where name = 'shared'").fetchone()[0] == 1
+
+def test_search(database, add_image):
+    h = lambda: format(random.getrandbits(256), "064x")
+    cat = add_image(h(), caption = "A cat sitting on a mat", keywords = {"animal"})
+    cats = add_image(h(), caption = "Cats cats cats", author = "catherine")
+    dog = add_image(h(), caption = "A dog on a mat", keywords = {"animal"})
+
+    assert database.search("cat") == [cats, cat]
+    assert set(database.search("mat")) == {cat, dog}
+    assert database.search('"on a mat" dog') == [dog]
+    assert database.search('"sitting mat"') == []
+    assert set(database.search("animal")) == {cat, dog}
+    note = add_image(h(), caption = "A note", author = "someone", keywords = {"note:catherine"})
+    assert set(database.search("cath")) == {cats, note}
+    assert database.search("author:cath") == [cats]
+    assert database.search("keywords:note") == [note]
+    assert database.search('caption:"a note"') == [note]
+    assert database.search("note:cath") == [note] # not a column, searched as words
+    assert database._search_query('author:cath "a b" source:"x y" http://a') == \
+        'author : "cath"* "a b" source : "x y" "http://a"*'
+    assert set(database.search("dog OR cats", raw = True)) == {cats, dog}
+    assert len(database.search("cat", limit = 1)) == 1
+
+    meta = database.get_meta(dog)
+    meta.caption = "Just a dog"
+    database.save_meta(meta)
+    assert database.search("mat") == [cat]
+
+    database.remove_image(cat)
+    assert database.search("animal") == [dog]
+
+def test_write_back(database, add_image):
+    uid = add_image(format(random.getrandbits(256), "064x"), caption = "before", collections = {"a", "b"})
+    xmpf = config.image_folder / (str(uid) + ".xmp")
+
+    meta = database.get_meta(uid)
+    for caption in ("edited", "after"):
+        meta.caption = caption
+        database.save_meta(meta)
+    # Repeated edits only get written once
+    assert sum(dirty.qsize() for dirty in database.__dirty) == 1
+    assert CuteMeta.from_file(xmpf).caption == "before"
+
+    for dirty in database.__dirty:
+        database._write_dirty(dirty, database.__db)
+
+    written = CuteMeta.from_file(xmpf)
+    assert written.caption == "after"
+    assert written.collections == {"a", "b"}
+    assert written.last_updated == database.get_meta(uid).last_updated
+    assert database._save_file(xmpf, database.__db) is False # stored the new stat, nothing to read again
+
+def test_write_back_threads(database, add_image, monkeypatch):
+    import threading
+
+    uid = add_image(format(random.getrandbits(256), "064x"), caption = "before")
+    meta = database.get_meta(uid)
+    meta.caption = "after"
+    database.save_meta(meta)
+    database._mark_dirty([uid, uid]) # Queued again before a writer took it
+
+    monkeypatch.setattr(database, "__writers_running", False)
+    database.start_writers()
+
+    def join():
+        for dirty in database.__dirty: dirty.join()
+    done = threading.Thread(target = join)
+    done.daemon = True
+    done.start()
+    done.join(5)
+    assert not done.is_alive()
+    assert CuteMeta.from_file(config.image_folder / (str(uid) + ".xmp")).caption == "after"
+
+def test_bulk_edit(database, add_image):
+    from cutespam.xmpmeta import Rating
+
+    h = lambda: format(random.getrandbits(256), "064x")
+    uids = [add_image(h(), caption = "cat", keywords = {"old"}) for _ in range(0, 5)]
+    other = add_image(h(), caption = "dog", keywords = {"old"})
+    before = database.get_meta(uids[0]).last_updated
+
+    database.add_keywords(uids[:3], ["new", "old"])
+    assert database.get_uids_from_keyword("new") == set(uids[:3])
+    assert database.get_tab_complete_keywords("ne") == {"new"}
+    assert set(database.search("new")) == set(uids[:3])
+
+    database.remove_keywords(uids + [other], ["old", "new"])
+    assert not database.get_uids_from_keyword("old") and not database.get_uids_from_keyword("new")
+    assert not database.get_tab_complete_keywords("ol")
+
+    database.set_field(uids, "caption", None)
+    database.set_field(uids, "rating", Rating.Safe)
+    assert database.get_uids_from_keyword("missing:caption") == set(uids)
+    assert database.get_uids_from_keyword("missing:rating") == {other}
+    assert database.get_meta(uids[0]).rating == Rating.Safe
+    assert database.get_meta(uids[0]).last_updated > before
+    assert database.get_meta(other).caption == "dog"
+
+    with pytest.raises(ValueError):
+        database.set_field(uids, "hash", h())
+    with pytest.raises(ValueError):
+        database.set_field(uids, "date", None)
+
+    # A failed edit doesn't change the completion
+    database.add_keywords(uids, ["kept"])
+    with pytest.raises(ZeroDivisionError):
+        database._bulk_edit(uids, lambda uids: (database._remove_keywords(uids, ["kept"], database.__db), 1 / 0), database.__db)
+    assert database.get_tab_complete_keywords("kep") == {"kept"}
+    database.remove_keywords(uids, ["kept"])
+    assert database.get_tab_complete_keywords("kep") == set()
+
+    for dirty in database.__dirty:
+        database._write_dirty(dirty, database.__db)
+    written = CuteMeta.from_file(config.image_folder / (str(uids[0]) + ".xmp"))
+    assert written.caption is None and written.rating == Rating.Safe
+    assert "missing:caption" in written.keywords and "old" not in written.keywords
+
+def test_get_metas(database, add_image):
+    from uuid import uuid4
+
+    h = lambda: format(random.getrandbits(256), "064x")
+    uids = [add_image(h(), caption = "cat %d" % n, author = "someone", collections = {"c%d" % n}) for n in range(0, 3)]
+    bare = add_image(h())
+    uids.append(bare)
+
+    metas = database.get_metas(list(reversed(uids)) + [uuid4()])
+    assert list(metas) == list(reversed(uids))
+    for uid in uids:
+        expected, meta = database.get_meta(uid), metas[uid]
+        assert meta.uid == uid
+        assert dict(meta.properties()) == dict(expected.properties())
+    assert metas[bare].collections is None
+
+    metas = database.get_metas(uids, ["caption", "authors", "keywords"])
+    assert metas[uids[0]].caption == "cat 0"
+    assert metas[uids[0]].author == "someone"
+    assert "author:someone" in metas[uids[0]].keywords
+    assert metas[uids[0]].hash is None and metas[uids[0]].collections is None
+
+def test_apply_file_events_rollback_hashes(database, add_image, write_image, monkeypatch):
+    from watchdog.events import FileCreatedEvent, FileDeletedEvent
+
+    h = lambda: format(random.getrandbits(256), "064x")
+    xmpf = lambda uid: config.image_folder / (str(uid) + ".xmp")
+    removed_hash, created_hash, good_hash = h(), h(), h()
+    removed = add_image(removed_hash)
+    created = write_image(created_hash)
+    good = write_image(good_hash)
+    xmpf(removed).unlink()
+
+    # Both fail after they changed the hashes
+    remove_image, update_search = database._remove_image, database._update_search
+    def broken_remove(uid, db):
+        remove_image(uid, db)
+        raise ValueError("broken")
+    def broken_search(uids, db):
+        if created in uids: raise ValueError("broken")
+        update_search(uids, db)
+    monkeypatch.setattr(database, "_remove_image", broken_remove)
+    monkeypatch.setattr(database, "_update_search", broken_search)
+
+    db = database.connect_db()
+    failed = database._apply_file_events([
+        (xmpf(removed), FileDeletedEvent(str(xmpf(removed)))),
+        (xmpf(created), FileCreatedEvent(str(xmpf(created)))),
+        (xmpf(good), FileCreatedEvent(str(xmpf(good)))),
+    ], db)
+    db.close()
+
+    assert len(failed) == 2
+    assert set(database.get_all_uids()) == {removed, good}
+    hashes = database.__hashes
+    assert removed_hash in hashes and good_hash in hashes
+    assert created_hash not in hashes
+
+def test_tag_command(database, add_image, capsys):
+    import importlib
+    from argparse import Namespace
+    tag = importlib.import_module("cutespam.cli.commands.tag")
+
+    uids = [add_image(format(random.getrandbits(256), "064x"), caption = "cat") for _ in range(0, 2)]
+    date = database.get_meta(uids[0]).date
+    run = lambda subcommand, tag_name, *values, files = uids: tag.main(
+        Namespace(subcommand = subcommand, tag = tag_name, value = list(values), file = [str(uid) for uid in files]))
+
+    run("delete", "date")
+    assert "date can't be empty" in capsys.readouterr().out
+    assert database.get_meta(uids[0]).date == date
+
+    # Both paths take the same values
+    for files in (uids, uids[:1]):
+        run("set", "caption", "a", "b", files = files)
+        assert "only takes a single value" in capsys.readouterr().out
+        assert database.get_meta(uids[0]).caption == "cat"
+    run("set", "caption", "dog")
+    assert [database.get_meta(uid).caption for uid in uids] == ["dog", "dog"]
+
+def test_probe_command(database, add_image, capsys):
+    import argparse, importlib
+    probe = importlib.import_module("cutespam.cli.commands.probe")
+
+    uid = add_image(format(random.getrandbits(256), "064x"), caption = "cat", authors = ["someone"])
+    parser = argparse.ArgumentParser()
+    probe.args(parser)
+
+    with pytest.raises(SystemExit): # Only tag names, author is a property of CuteMeta
+        parser.parse_args([str(uid), "--tag", "author"])
+    capsys.readouterr()
+
+    probe.main(parser.parse_args([str(uid), "--tag", "authors"]))
+    assert capsys.readouterr().out.strip() == "['someone']"
+
+def test_tab_complete(start_database, write_image):
+    from uuid import UUID
+
+    h = lambda: format(random.getrandbits(256), "064x")
+    first = write_image(h(), keywords = {"tag:one", "tag:shared"}, uid = UUID("abcdef12abcdef12abcdef12abcdef12"))
+    database = start_database()
+    database.load_file(config.image_folder / (str(write_image(h(), keywords = {"tag:two", "tag:shared"})) + ".xmp"))
+
+    assert database.get_tab_complete_keywords("tag:") == {"tag:one", "tag:two", "tag:shared"}
+    assert database.get_tab_complete_uids("abcdef12-abcd") == {first}
+
+    (config.image_folder / (str(first) + ".xmp")).unlink()
+    database.remove_image(first)
+    assert database.get_tab_complete_keywords("TAG:") == {"tag:two", "tag:shared"}
+    assert database.get_tab_complete_uids("abcdef12-abcd") == set()
+
+    database = start_database() # Gets rebuilt from the database
+    assert database.get_tab_complete_keywords("tag:") == {"tag:two", "tag:shared"}
+
+def test_tab_complete_rollback(database, write_image, monkeypatch):
+    from watchdog.events import FileCreatedEvent
+
+    h = lambda: format(random.getrandbits(256), "064x")
+    uid = write_image(h(), keywords = {"tag:rolled_back"})
+    xmpf = config.image_folder / (str(uid) + ".xmp")
+
+    update_search = database._update_search
+    def broken(uids, db): raise ValueError("broken")
+    monkeypatch.setattr(database, "_update_search", broken)
+    db = database.connect_db()
+    assert database._apply_file_events([(xmpf, FileCreatedEvent(str(xmpf)))], db) == [FileCreatedEvent(str(xmpf))]
+    assert database.get_tab_complete_keywords("tag:") == set()
+    assert database.get_tab_complete_uids(uid.hex) == set()
+
+    database._insert_keywords([(uid, "tag:other")], db)
+    db.rollback()
+    assert database.get_tab_complete_keywords("tag:") == set()
+    monkeypatch.setattr(database, "_update_search", update_search)
+
+    database._apply_file_events([(xmpf, FileCreatedEvent(str(xmpf)))], db)
+    db.close()
+    assert database.get_tab_complete_keywords("tag:") == {"tag:rolled_back"}
+    assert database.get_tab_complete_uids(uid.hex) == {uid}
+
+def test_tag_regex(database):
+    import sqlite3
+    from uuid import uuid4
+
+    conn = database.__db
+    database._compile_regexp.cache_clear()
+    for invalid in ("", " ", "*", ":"): # The expression isn't anchored, one valid character is enough
+        with pytest.raises(sqlite3.IntegrityError):
+            conn.execute("insert into Metadata_Collections values (?, ?)", (uuid4(), invalid))
+    conn.executemany("insert into Metadata_Collections values (?, ?)", [(uuid4(), "collection%d" % n) for n in range(0, 100)])
+    conn.rollback()
+
+    assert database._compile_regexp.cache_info().misses == 1 # compiled once, not for every row
+
+def test_tag_regex_benchmark(data_folder, database, record_property):
+    from time import perf_counter
+    from uuid import uuid4
+
+    if not data_folder: pytest.skip("needs --data-folder")
+    conn = database.__db
+    rows = [(uuid4(), "collection%d" % (n % 100)) for n in range(0, 50_000)]
+    start = perf_counter()
+    conn.executemany("insert into Metadata_Collections values (?, ?)", rows)
+    elapsed = perf_counter() - start
+    conn.rollback()
+
+    record_property("rows_per_second", len(rows) / elapsed)
+
+def test_apply_file_events(database, write_image):
+    from uuid import uuid4
+    from watchdog.events import FileCreatedEvent, FileModifiedEvent, FileDeletedEvent
+
+    h = lambda: format(random.getrandbits(256), "064x")
+    xmpf = lambda uid: config.image_folder / (str(uid) + ".xmp")
+
+    existing = [write_image(h(), caption = "before") for _ in range(0, 2)]
+    for uid in existing: database.load_file(xmpf(uid))
+    created = [write_image(h()) for _ in range(0, 20)]
+    broken = xmpf(uuid4())
+    broken.write_text("not xml")
+
+    meta = CuteMeta.from_file(xmpf(existing[0]))
+    meta.caption = "after"
+    meta.last_updated = meta.last_updated.replace(year = meta.last_updated.year + 1)
+    meta.write()
+    xmpf(existing[1]).unlink()
+
+    events = [(xmpf(uid), FileCreatedEvent(str(xmpf(uid)))) for uid in created]
+    events.append((broken, FileCreatedEvent(str(broken))))
+    events.append((xmpf(existing[0]), FileModifiedEvent(str(xmpf(existing[0])))))
+    events.append((xmpf(existing[1]), FileDeletedEvent(str(xmpf(existing[1])))))
+
+    db = database.connect_db()
+    statements = []
+    db.set_trace_callback(statements.append)
+    failed = database._apply_file_events(events, db)
+    db.close()
+
+    assert failed == [FileCreatedEvent(str(broken))]
+    assert statements.count("COMMIT") == 1
+    assert set(database.get_all_uids()) == set(created) | {existing[0]}
+    assert database.get_meta(existing[0]).caption == "after"
+
+def test_apply_file_events_locked(database, write_image, monkeypatch):
+    import sqlite3, time
+
+    apply_file_events = database._apply_file_events
+    calls = []
+    def locked(events, db):
+        calls.append(events)
+        if len(calls) == 1: raise sqlite3.OperationalError("database is locked")
+        return apply_file_events(events, db)
+
+    monkeypatch.setattr(database, "_apply_file_events", locked)
+    monkeypatch.setattr(database, "_EVENT_DELAY", 0.1)
+    database.listen_for_file_changes()
+
+    uid = write_image(format(random.getrandbits(256), "064x"))
+    # Retried by the backlog after the first batch failed
+    for _ in range(0, 100):
+        if uid in database.get_all_uids(): break
+        time.sleep(0.1)
+    assert uid in database.get_all_uids()
+    assert len(calls) >= 2
+
+def test_concurrent_reads(database, add_image, monkeypatch):
+    import threading, time
+    from uuid import uuid4
+
+    for _ in range(0, 10): add_image(format(random.getrandbits(256), "064x"))
+    monkeypatch.setattr(config, "db_busy_timeout", 0.1)
+
+    reader = database.connect_db()
+    writer = database.connect_db()
+    assert reader.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+    # A reader in the middle of a transaction doesn't keep the writer from committing
+    reader.execute("BEGIN")
+    assert reader.execute("select count(*) from Metadata").fetchone()[0] == 10
+    writer.execute("insert into Metadata (uid, hash) values (?, ?)", (uuid4(), "0"))
+    writer.commit()
+    assert reader.execute("select count(*) from Metadata").fetchone()[0] == 10
+    reader.commit()
+    assert reader.execute("select count(*) from Metadata").fetchone()[0] == 11
+
+    writer.close()
+
+    # Reads go on while a bulk write is running
+    def bulk_write():
+        writer = database.connect_db()
+        writer.execute("BEGIN IMMEDIATE")
+        started.set()
+        writer.executemany("insert into Metadata_Collections values (?, ?)", ((uuid4(), "bulk") for _ in range(0, 100_000)))
+        time.sleep(0.5)
+        writer.commit()
+        writer.close()
+
+    started = threading.Event()
+    thread = threading.Thread(target = bulk_write)
+    thread.start()
+    assert started.wait(5)
+
+    reads = 0
+    while thread.is_alive():
+        reader.execute("select count(*) from Metadata_Collections where collection = 'bulk'").fetchone()
+        reads += 1
+    thread.join()
+
+    assert reads > 1
+    assert reader.execute("select count(*) from Metadata_Collections where collection = 'bulk'").fetchone()[0] == 100_000
+    reader.close()
@@ -0,0 +1,82 @@
+import pytest, random
+
+from PIL import Image
+
+from cutespam import hash as cutehash
+from cutespam.hash import HashCache, hash_img, hash_imgs
+
+@pytest.fixture(autouse = True)
+def cache(tmp_path, monkeypatch):
+    from cutespam.config import config
+
+    monkeypatch.setattr(config, "hashcachef", tmp_path / "hashcache.db")
+    monkeypatch.setattr(cutehash, "__cache", None)
+    yield
+    cache = getattr(cutehash, "__cache")
+    if cache: cache.close()
+
+@pytest.fixture
+def images(tmp_path):
+    files = []
+    for n in range(0, 12):
+        img = Image.new("RGB", (random.randint(64, 300), random.randint(64, 300)))
+        img.putdata([tuple(random.getrandbits(8) for _ in range(3)) for _ in range(img.width * img.height)])
+        files.append(tmp_path / ("%d.%s" % (n, "png" if n % 2 else "jpg")))
+        img.save(files[-1])
+    return files
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_hash_imgs(images, workers):
+    expected = {file: hash_img(file) for file in images}
+
+    assert list(hash_imgs(images, workers, ordered = True)) == list(expected.items())
+    assert dict(hash_imgs(images, workers)) == expected
+
+def test_hash_imgs_broken_file(tmp_path, images):
+    broken = tmp_path / "broken.jpg"
+    broken.write_bytes(b"not an image")
+
+    result = dict(hash_imgs(images + [broken], 2))
+    assert result[broken] is None
+    assert len(result) == len(images) + 1
+
+def test_hash_cache(images, monkeypatch):
+    expected = {file: hash_img(file) for file in images}
+
+    def fail(fp): raise AssertionError("%s wasn't cached" % fp)
+    monkeypatch.setattr(cutehash.Image, "open", fail)
+    
+    assert {file: hash_img(file) for file in images} == expected
+    assert dict(hash_imgs(images, 2)) == expected
+
+    with pytest.raises(AssertionError):
+        images[0].write_bytes(images[1].read_bytes())
+        hash_img(images[0])
+
+def test_hash_cache_eviction(tmp_path, images):
+    cache = HashCache(tmp_path / "cache.db", 5)
+    for n, file in enumerate(images):
+        cache.put(file, str(n))
+        cache.get(images[0])
+
+    cache.put(images[0], "0")
+    assert cache.get(images[0]) == "0"
+    assert cache.get(images[-1]) == str(len(images) - 1)
+    assert cache._db.execute("select count(*) from HashCache").fetchone()[0] <= 6
+    cache.close()
+
+def test_hash_cache_last_used(tmp_path, images):
+    cache = HashCache(tmp_path / "cache.db", 100)
+    cache.put(images[0], "0")
+    last_used = lambda: cache._db.execute("select last_used from HashCache").fetchone()[0]
+    before = last_used()
+
+    statements = []
+    cache._db.set_trace_callback(statements.append)
+    for _ in range(0, 10): assert cache.get(images[0]) == "0"
+    assert not [s for s in statements if not s.startswith("select")] # hits don't write
+    assert last_used() == before
+
+    cache._write_used()
+    assert last_used() > before
+    cache.close()
@@ -0,0 +1,62 @@
+import pytest, random
+
+from cutespam.hashindex import HashIndexFile, write_index, is_index_file
+from cutespam.hashtree import CompactHashTree
+from cutespam.hashmatrix import HashMatrix
+from cutespam.multiindex import MultiIndexHash
+
+def test_index_file(tmp_path):
+    file = tmp_path / "hashes.db"
+    keys = sorted(random.getrandbits(256) for _ in range(0, 1000))
+    write_index(file, keys, 256)
+
+    assert is_index_file(file)
+    index = HashIndexFile(file, 256)
+    assert list(index) == keys
+    for key in keys[:20]:
+        assert key in index
+        assert format(key, "x") in index
+    assert random.getrandbits(256) not in index
+    index.close()
+
+    with pytest.raises(ValueError):
+        HashIndexFile(file, 64)
+
+def test_index_file_update(tmp_path):
+    file = tmp_path / "hashes.db"
+    keys = sorted(random.getrandbits(256) for _ in range(0, 1000))
+    write_index(file, keys, 256)
+
+    # The file gets replaced, an index that is still open keeps the old keys
+    old = HashIndexFile(file, 256)
+    new_keys = keys[10:-10]
+    write_index(file, new_keys, 256)
+    assert list(old) == keys
+    old.close()
+    index = HashIndexFile(file, 256)
+    assert list(index) == new_keys
+    index.close()
+    assert [f.name for f in tmp_path.iterdir()] == ["hashes.db"]
+
+    # Files that aren't an index get replaced
+    file.write_bytes(b"\xfd7zXZ" + bytes(100))
+    write_index(file, new_keys, 256)
+    assert is_index_file(file)
+
+@pytest.mark.parametrize("backend", [CompactHashTree, HashMatrix, MultiIndexHash])
+def test_backend_index(tmp_path, backend):
+    file = tmp_path / "hashes.db"
+    hashes = backend(256)
+    for _ in range(0, 200):
+        hashes.add(random.getrandbits(256))
+    hashes.write_to_index(file)
+
+    read = backend.read_from_index(file, 256)
+    assert set(read) == set(hashes)
+    key = random.choice(list(hashes))
+    assert read.find_all_hamming_distance(key, 128) == hashes.find_all_hamming_distance(key, 128)
+
+    read.remove(key)
+    read.add(1)
+    read.write_to_index(file)
+    assert list(HashIndexFile(file, 256)) == sorted((set(hashes) - set([key])) | set([1]))
@@ -0,0 +1,75 @@
+import pytest, random, io
+
+from cutespam.hashtree import CompactHashTree
+from cutespam.hashmatrix import HashMatrix
+
+def test_hash_matrix_remove():
+    matrix = HashMatrix(256)
+    rndints = []
+    for _ in range(0, 100):
+        rndint = random.getrandbits(256)
+        rndints.append(rndint)
+        matrix.add(rndint)
+
+    assert set(matrix) == set(rndints)
+    with pytest.raises(KeyError):
+        matrix.add(rndints[0])
+
+    random.shuffle(rndints)
+    for r in list(rndints):
+        rndints.remove(r)
+        assert r in matrix
+        matrix.remove(r)
+        assert r not in matrix
+
+        for other in rndints:
+            assert other in matrix
+    
+    assert len(matrix) == 0
+
+def test_hash_matrix_same_as_tree():
+    tree = CompactHashTree(256)
+    matrix = HashMatrix(256)
+    base = random.getrandbits(256)
+    for _ in range(0, 300):
+        num = base
+        for m in random.sample(range(0, 256), random.randint(0, 40)):
+            num ^= 1 << m
+        if num in tree: continue
+        tree.add(num)
+        matrix.add(num)
+
+    for key in random.sample(list(tree), 10) + [random.getrandbits(256)]:
+        for distance in (0, 1, 10, 30, 60, 256):
+            assert matrix.find_all_hamming_distance(key, distance) == tree.find_all_hamming_distance(key, distance)
+            assert matrix.find_all_hamming_distance(key, distance, 10) == tree.find_all_hamming_distance(key, distance, 10)
+
+def test_hash_matrix_serialization():
+    matrix = HashMatrix(256)
+    for _ in range(0, 30):
+        matrix.add(random.getrandbits(256))
+
+    stream = io.BytesIO()
+    matrix.serialize_to_bitstream(stream)
+    stream.seek(0)
+    assert set(CompactHashTree.deserialize_from_bitstream(stream, 256)) == set(matrix)
+    stream.seek(0)
+    assert set(HashMatrix.deserialize_from_bitstream(stream, 256)) == set(matrix)
+
+def test_hash_matrix_batch(monkeypatch):
+    from cutespam import hashmatrix
+    monkeypatch.setattr(hashmatrix, "_ROW_BLOCK", 16) # Matches and limits carry over many row blocks
+
+    matrix = HashMatrix(256)
+    base = random.getrandbits(256)
+    for _ in range(0, 300):
+        num = base
+        for m in random.sample(range(0, 256), random.randint(0, 40)):
+            num ^= 1 << m
+        if num not in matrix: matrix.add(num)
+
+    keys = random.sample(list(matrix), 40) + [random.getrandbits(256)]
+    for distance in (0, 10, 60, 256):
+        for limit in (None, 1, 10):
+            found = matrix.find_all_hamming_distance_batch(keys, distance, limit)
+            assert found == {key: matrix.find_all_hamming_distance(key, distance, limit) for key in keys}
@@ -1,6 +1,6 @@
-import pytest, random
+import pytest, random, io
 
-from cutespam.hashtree import HashTree
+from cutespam.hashtree import HashTree, CompactHashTree
 
 def test_hash_tree_insert():
     tree = HashTree(256)
@@ -106,4 +106,104 @@ def test_find_hamming_distance():
         test = n[1]
         for distance in range(0, len(test)):
             assert find_all_hamming_distance(tree, find, distance) == set(test[:distance])
-    
\ No newline at end of file
+    
+def test_compact_hash_tree_remove():
+    tree = CompactHashTree(256)
+    rndints = []
+    for _ in range(0, 50):
+        rndint = random.getrandbits(256)
+        rndints.append(rndint)
+        tree.add(rndint)
+
+    assert list(tree) == sorted(rndints)
+    with pytest.raises(KeyError):
+        tree.add(rndints[0])
+
+    random.shuffle(rndints)
+    for r in list(rndints):
+        rndints.remove(r)
+        assert r in tree
+        tree.remove(r)
+        assert r not in tree
+
+        for other in rndints:
+            assert other in tree
+        assert len(tree) == len(rndints)
+    
+    assert tree._root is None
+
+def test_compact_find_hamming_distance():
+    tree = CompactHashTree(64)
+    compare = HashTree(64)
+    base = random.getrandbits(64)
+    for _ in range(0, 200):
+        num = base
+        for m in random.sample(range(0, 64), random.randint(0, 12)):
+            num ^= 1 << m
+        if num in tree: continue
+        tree.add(num)
+        compare.add(num)
+
+    for key in random.sample(list(tree), 10):
+        for distance in (0, 1, 4, 8):
+            expected = set((bin(key ^ v).count("1"), v) for v in tree if 0 < bin(key ^ v).count("1") <= distance)
+            assert tree.find_all_hamming_distance(key, distance) == expected
+            assert compare.find_all_hamming_distance(key, distance) == expected
+
+    # keys that aren't part of the tree can be searched as well
+    key = base ^ 0b1
+    if key not in tree:
+        expected = set((bin(key ^ v).count("1"), v) for v in tree if bin(key ^ v).count("1") <= 4)
+        assert tree.find_all_hamming_distance(key, 4) == expected
+
+    result = tree.find_all_hamming_distance(base, 64, limit = 5)
+    assert len(result) == 5
+    assert max(d for d, _ in result) <= min(bin(base ^ v).count("1") for v in tree if v not in [h for _, h in result] and v != base)
+
+def test_compact_tree_serialization():
+    tree = HashTree(256)
+    compact = CompactHashTree(256)
+    for _ in range(0, 30):
+        num = random.getrandbits(256)
+        tree.add(num)
+        compact.add(num)
+
+    assert list(tree._serialize()) == list(compact._serialize())
+
+    stream = io.BytesIO()
+    compact.serialize_to_bitstream(stream)
+    stream.seek(0)
+    assert set(HashTree.deserialize_from_bitstream(stream, 256)) == set(tree)
+    stream.seek(0)
+    assert set(CompactHashTree.deserialize_from_bitstream(stream, 256)) == set(tree)
+
+def test_tree_file_chunks(monkeypatch):
+    import cutespam.hashtree
+    monkeypatch.setattr(cutespam.hashtree, "_CHUNK_SIZE", 7) # Split values between chunks
+
+    tree = HashTree(256)
+    for _ in range(0, 30):
+        tree.add(random.getrandbits(256))
+
+    stream = io.BytesIO()
+    tree.write_to_file(stream)
+    stream.seek(0)
+
+    progress = []
+    tree2 = HashTree.read_from_file(stream, 256, progress = lambda done, total: progress.append((done, total)))
+    assert list(tree2) == list(tree)
+    assert len(tree2) == len(tree)
+    assert progress and progress[-1][0] == progress[-1][1] == len(stream.getvalue())
+
+def test_find_hamming_distance_missing_key():
+    for _ in range(0, 20):
+        tree = HashTree(10)
+        values = set(random.sample(range(0, 1024), 60))
+        tree |= values
+
+        for key in random.sample(range(0, 1024), 20):
+            for distance in range(0, 6):
+                expected = set(v for v in values if 0 < bin(key ^ v).count("1") <= distance)
+                assert find_all_hamming_distance(tree, key, distance) == expected
+            assert (key in tree) == (key in values)
+            assert set(tree) == values
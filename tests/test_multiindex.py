@@ -0,0 +1,69 @@
+import pytest, random
+
+from cutespam.hashtree import CompactHashTree
+from cutespam.multiindex import MultiIndexHash
+
+def test_multi_index_remove():
+    index = MultiIndexHash(256)
+    rndints = []
+    for _ in range(0, 100):
+        rndint = random.getrandbits(256)
+        rndints.append(rndint)
+        index.add(rndint)
+
+    assert set(index) == set(rndints)
+    with pytest.raises(KeyError):
+        index.add(rndints[0])
+
+    random.shuffle(rndints)
+    for r in list(rndints):
+        rndints.remove(r)
+        index.remove(r)
+        assert r not in index
+        assert len(index) == len(rndints)
+    
+    assert not any(index._tables)
+
+@pytest.mark.parametrize("hash_length", [64, 250, 256])
+def test_multi_index_same_as_tree(hash_length):
+    tree = CompactHashTree(hash_length)
+    index = MultiIndexHash(hash_length)
+    base = random.getrandbits(hash_length)
+    for _ in range(0, 500):
+        num = base
+        for m in random.sample(range(0, hash_length), random.randint(0, 50)):
+            num ^= 1 << m
+        if num in tree: continue
+        tree.add(num)
+        index.add(num)
+
+    for key in random.sample(list(tree), 10) + [random.getrandbits(hash_length)]:
+        for distance in (0, 1, 16, 38, 60, hash_length):
+            assert index.find_all_hamming_distance(key, distance) == tree.find_all_hamming_distance(key, distance)
+            assert index.find_all_hamming_distance(key, distance, 10) == tree.find_all_hamming_distance(key, distance, 10)
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_find_all_pairs(workers):
+    from cutespam.multiindex import find_all_pairs
+
+    keys = set()
+    for _ in range(0, 20):
+        base = random.getrandbits(64)
+        keys.add(base)
+        for _ in range(0, 10):
+            num = base
+            for m in random.sample(range(0, 64), random.randint(1, 12)):
+                num ^= 1 << m
+            keys.add(num)
+    keys = list(keys)
+
+    for distance in (0, 3, 10):
+        expected = set()
+        for i, a in enumerate(keys):
+            for b in keys[i + 1:]:
+                d = bin(a ^ b).count("1")
+                if d <= distance: expected.add((d, min(a, b), max(a, b)))
+
+        pairs = find_all_pairs(keys, 64, distance, workers)
+        assert len(pairs) == len(expected)
+        assert set(pairs) == expected
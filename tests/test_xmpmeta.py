@@ -1,3 +1,4 @@
+import pytest
 
 from pathlib import Path
 from tempfile import TemporaryFile
@@ -31,4 +32,162 @@ def test_metadata():
     cm3.read()
 
     assert cm.as_dict() == cm2.as_dict() == cm3.as_dict()
-    
\ No newline at end of file
+    
+def read_reference(meta):
+    """ How Meta.read used to look up every tag with root.find, read needs to give the same results """
+    from cutespam.xmpmeta import RDF_NS, ET
+
+    def deserialize(value, tpe):
+        if tpe is datetime:
+            return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%fZ")
+        return tpe(value)
+
+    with open(meta.filename, "r") as file:
+        root = ET.fromstring(file.read())
+
+    for k in meta.tag_names():
+        value = None
+        tag = getattr(type(meta), k)
+
+        if tag.tag_type:
+            elem = root.find(f".//{tag.tag_name}")
+            if elem is not None:
+                if tag.tag_type == "{%s}Alt" % RDF_NS:
+                    value = elem[0][0].text
+                else:
+                    value = tag.type(v.text for v in elem[0])
+        else:
+            description = root.find(".//{%s}Description[@%s]" % (RDF_NS, tag.tag_name))
+            if description is not None:
+                value = deserialize(description.attrib[tag.tag_name], tag.type)
+            elem = root.find(f".//{tag.tag_name}")
+            if elem is not None and len(elem): # only elements with children counted
+                value = deserialize(elem.text, tag.type)
+
+        setattr(meta, k, value)
+
+def test_read_unusual_files(tmp_path):
+    xmp = TEST_XMP.read_text()
+    files = {
+        "missing.xmp": xmp.replace('cute:rating="q"', "").replace("<dc:subject>", "<dc:other>").replace("</dc:subject>", "</dc:other>"),
+        "comment.xmp": xmp.replace("<rdf:Bag>\n", "<rdf:Bag><!-- comment -->\n", 1),
+        "split.xmp": xmp.replace('dc:source="http://example.com/example_image.jpg"', "").replace(
+            "</rdf:RDF>", '<rdf:Description xmlns:dc="http://purl.org/dc/elements/1.1/" dc:source="http://example.com/second.jpg"/></rdf:RDF>'),
+        "element.xmp": xmp.replace("<dc:creator>", '<dc:source><rdf:Seq/></dc:source><dc:creator>'),
+    }
+
+    for name, content in files.items():
+        (tmp_path / name).write_text(content)
+        expected = CuteMeta(filename = tmp_path / name)
+        try: read_reference(expected)
+        except Exception as e: expected = type(e)
+        else: expected = expected.as_dict()
+
+        meta = CuteMeta(filename = tmp_path / name)
+        try: meta.read()
+        except Exception as e: meta = type(e)
+        else: meta = meta.as_dict()
+
+        assert meta == expected, name
+
+def test_read_benchmark(data_folder):
+    from time import perf_counter
+
+    if not data_folder: pytest.skip("needs --data-folder")
+    files = list(Path(data_folder).glob("*.xmp"))
+
+    start = perf_counter()
+    expected = []
+    for file in files:
+        meta = CuteMeta(filename = file)
+        read_reference(meta)
+        expected.append(meta.as_dict())
+    reference = perf_counter() - start
+
+    start = perf_counter()
+    metas = [CuteMeta.from_file(file).as_dict() for file in files]
+    read = perf_counter() - start
+
+    print(f"\n{len(files)} files, root.find: {reference:.2f}s, read: {read:.2f}s, {reference / read:.1f}x")
+    assert metas == expected
+
+def write_reference(meta, filename):
+    """ How Meta.write used to build the file with lxml, write needs to give the same output """
+    from copy import deepcopy
+    from enum import Enum
+    from cutespam.xmpmeta import RDF_NS, ET
+
+    def serialize(value, tpe):
+        if issubclass(tpe, Enum): return value.value
+        elif tpe is datetime: return value.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        return str(value)
+
+    root = deepcopy(type(meta)._XMP_ETREE)
+    description = root.find(".//{%s}Description" % RDF_NS)
+    for k, value in meta.properties():
+        tag = getattr(type(meta), k)
+        if value is None: continue
+        if tag.tag_type:
+            if not value: continue
+            propety = ET.SubElement(description, tag.tag_name)
+            elem = ET.SubElement(propety, tag.tag_type)
+            if tag.tag_type == "{%s}Alt" % RDF_NS:
+                v = ET.SubElement(elem, "{%s}li" % RDF_NS)
+                v.attrib["{http://www.w3.org/XML/1998/namespace}lang"] = "x-default"
+                v.text = serialize(value, tag.type)
+            else:
+                for e in value:
+                    ET.SubElement(elem, "{%s}li" % RDF_NS).text = e
+        else:
+            description.attrib[tag.tag_name] = serialize(value, tag.type)
+
+    with open(filename, "w") as file:
+        file.write(ET.tostring(root, method = "xml", pretty_print = True).decode())
+
+def test_write_same_as_lxml(tmp_path):
+    metas = [CuteMeta.from_file(TEST_XMP), CuteMeta(filename = TEST_XMP)]
+
+    odd = CuteMeta.from_file(TEST_XMP)
+    odd.caption = 'Line one\nline "two" <b>&amp;</b>\r\tätsch ✓ 𝄞'
+    odd.authors = ["a&b", "ü", "x > y"]
+    odd.source = 'http://example.com/?a=1&b="2"\n\t<'
+    odd.keywords = {"", "tag", None}
+    odd.collections = set()
+    odd.rating = None
+    metas.append(odd)
+
+    only_lists = CuteMeta(filename = TEST_XMP)
+    only_lists.keywords = {"a", "b"}
+    metas.append(only_lists)
+
+    for n, meta in enumerate(metas):
+        meta._filename = tmp_path / f"{n}.xmp"
+        meta.write()
+        write_reference(meta, tmp_path / f"{n}_reference.xmp")
+        assert (tmp_path / f"{n}.xmp").read_bytes() == (tmp_path / f"{n}_reference.xmp").read_bytes()
+    assert not list(tmp_path.glob(".*")) # no temporary files left
+
+    broken = CuteMeta.from_file(TEST_XMP)
+    broken._filename = tmp_path / "0.xmp"
+    broken.caption = "null \x00 byte"
+    with pytest.raises(ValueError):
+        broken.write()
+    assert CuteMeta.from_file(tmp_path / "0.xmp").caption == "Test Caption"
+    assert not list(tmp_path.glob(".*"))
+
+def test_write_keeps_file(tmp_path):
+    import os, stat
+
+    target = tmp_path / "target.xmp"
+    target.write_bytes(TEST_XMP.read_bytes())
+    target.chmod(0o664)
+    link = tmp_path / "link.xmp"
+    link.symlink_to(target)
+
+    meta = CuteMeta.from_file(link)
+    meta.caption = "Changed"
+    meta.write()
+
+    assert link.is_symlink()
+    assert stat.S_IMODE(os.stat(target).st_mode) == 0o664
+    assert CuteMeta.from_file(target).caption == "Changed"